@@ -8,10 +8,18 @@ Utilities to handle braille labels in various formats:
     human_labels: labels in a manual annotation
 '''
 from collections import defaultdict
+from functools import lru_cache
 from . import letters
 
 v = [1, 2, 4, 8, 16, 32]
 
+# conversion tables for all 64 int_labels
+_labels010 = tuple(''.join('1' if int_lbl & b else '0' for b in v) for int_lbl in range(64))
+_labels123 = tuple(''.join(str(i+1) for i in range(6) if int_lbl & v[i]) for int_lbl in range(64))
+_unicode_chars = tuple(chr(0x2800 + int_lbl) for int_lbl in range(64))
+_vflipped = tuple(((int_lbl&(1+8))<<2) + ((int_lbl&(4+32))>>2) + (int_lbl&(2+16)) for int_lbl in range(64))
+_hflipped = tuple(((int_lbl&(1+2+4))<<3) + ((int_lbl&(8+16+32))>>3) for int_lbl in range(64))
+
 def validate_int(int_label):
     '''
     Validate int_label is in [0..63]
@@ -33,31 +41,24 @@ def label_vflip(int_lbl):
     convert int_label in case of vertical flip
     '''
     validate_int(int_lbl)
-    return ((int_lbl&(1+8))<<2) + ((int_lbl&(4+32))>>2) + (int_lbl&(2+16))
+    return _vflipped[int_lbl]
 
 def label_hflip(int_lbl):
     '''
     convert int_label in case of horizontal flip
     '''
     validate_int(int_lbl)
-    return ((int_lbl&(1+2+4))<<3) + ((int_lbl&(8+16+32))>>3)
+    return _hflipped[int_lbl]
 
 def int_to_label010(int_lbl):
-    int_lbl = int(int_lbl)
-    r = ""
-    for i in range(6):
-        r += '1' if int_lbl&v[i] else '0'
-    return r
+    return _labels010[int(int_lbl) & 63]  # bits above 6 dots are ignored
 
 def int_to_label123(int_lbl):
-    int_lbl = int(int_lbl)
-    r = ""
-    for i in range(6):
-        if int_lbl & v[i]:
-            r += str(i+1)
-    return r
+    return _labels123[int(int_lbl) & 63]
 
 def int_to_unicode(int_lbl):
+    if 0 <= int_lbl < 64:
+        return _unicode_chars[int_lbl]
     return chr(0x2800 + int_lbl)
 
 def unicode_to_int(unicode_lbl):
@@ -127,13 +128,24 @@ def int_to_letter(int_lbl, langs):
     :param langs: list of language dict codes (see letters.letter_dicts)
     :return: letter or string (for special symbols that need postprocessing) or None
     '''
-    label123 = int_to_label123(int_lbl)
-    for lang in langs:
+    return letters_table(*langs)[int(int_lbl) & 63]
+
+
+@lru_cache(maxsize=None)
+def letters_table(*langs):
+    '''
+    Table of int_to_letter(int_lbl, langs) results for all int_lbl in [0..63]
+    :param langs: language dict codes (see letters.letter_dicts)
+    :return: tuple of 64 letters (or strings or None)
+    '''
+    table = [None] * 64
+    for lang in reversed(langs):
         d = letters.letter_dicts[lang]
-        res = d.get(label123, None)
-        if res is not None:
-            return res
-    return None
+        for int_lbl in range(64):
+            res = d.get(_labels123[int_lbl], None)
+            if res is not None:
+                table[int_lbl] = res
+    return tuple(table)
 
 
 # global dict: letter (or spec. string) -> set of labels123 from different dicts from letters.letter_dicts
@@ -1,6 +1,8 @@
 import cv2
 from collections import defaultdict
-from functools import cmp_to_key
+from functools import cmp_to_key, lru_cache
+from itertools import chain
+from operator import attrgetter
 import numpy as np
 import PIL
 
@@ -10,6 +12,9 @@ from braille_utils.postprocess_liblouis import interpret_line_liblouis
 
 
 class LineChar:
+    __slots__ = ('original_box', 'x', 'y', 'w', 'h', 'approximation', 'refined_box', 'label', 'spaces_before',
+                 'char', 'labeling_char')
+
     def __init__(self, box, label):
         self.original_box = box # box found by NN
         self.x = (box[0] + box[2])/2 # original x of last char
@@ -24,11 +29,25 @@ class LineChar:
         self.labeling_char = '' # char to display in rects labeling
 
 
+@lru_cache(maxsize=None)
+def _approximation_pairs(n, min_dist):
+    '''
+    Pairs of chars checked by Line._calc_approximation for n chars
+    :return: tuple of (i, j, ks), ks - indexes of other chars
+    '''
+    return tuple((i, j, tuple(k for k in range(n) if k != i and k != j))
+                 for i in range(n - min_dist) for j in range(i + min_dist, n))
+
+
 class Line:
     STEP_TO_W = 1.25
     LINE_THR = 0.6
     AVG_PERIOD = 5 # для аппроксимации при коррекции
     AVG_APPROX_DIST = 3 # берутся точки с интервалос не менее 2, т.е. 0я и 3я или 1я и 4я
+    VECTORIZE_MIN_ERRORS = 64 # _calc_approximation_np is used if more errors are to be calculated
+
+    # length, middle_x, mean_slip are set by _sort_lines
+    __slots__ = ('chars', 'x', 'y', 'h', 'slip', 'has_space_before', 'length', 'middle_x', 'mean_slip')
 
     def __init__(self, box, label):
         self.chars = []
@@ -62,24 +81,49 @@ class Line:
         return False
 
     def _calc_approximation(self, calc_chars):
+        '''
+        Finds line through centers of a pair of chars i, j (at least AVG_APPROX_DIST apart) which is the nearest
+        to center of some 3rd char k
+        :return: err (distance of k to the line), a, b (y = a*x + b), w, h (mean of i, j, k) or None if there are not
+            enough chars
+        '''
         if len(calc_chars) <= self.AVG_APPROX_DIST:
             return None
-        best_pair = [1e99, None, None, None, None, ] # err,i,j,k,a,b
-        for i in range(len(calc_chars)-self.AVG_APPROX_DIST):
-            for j in range(i+self.AVG_APPROX_DIST, len(calc_chars)):
-                a = (calc_chars[j].y - calc_chars[i].y) / (calc_chars[j].x - calc_chars[i].x)
-                b = (calc_chars[j].x * calc_chars[i].y - calc_chars[i].x * calc_chars[j].y) / (calc_chars[j].x - calc_chars[i].x)
-                ks = [k for k in range(len(calc_chars)) if k!=i and k!= j]
-                errors = [abs(calc_chars[k].x * a + b - calc_chars[k].y) for k in ks]
-                min_err = min(errors)
-                if min_err < best_pair[0]:
-                    idx_if_min = min(range(len(errors)), key=errors.__getitem__)
-                    best_pair = min_err, i, j, ks[idx_if_min], a, b
-        err, i, j, k, a, b = best_pair
+        pairs = _approximation_pairs(len(calc_chars), self.AVG_APPROX_DIST)
+        if len(pairs) * (len(calc_chars) - 2) > self.VECTORIZE_MIN_ERRORS:
+            err, i, j, k, a, b = self._calc_approximation_np(calc_chars, pairs)
+        else:
+            xs = [ch.x for ch in calc_chars]
+            ys = [ch.y for ch in calc_chars]
+            best_pair = [1e99, None, None, None, None, None] # err,i,j,k,a,b
+            for i, j, ks in pairs:
+                a = (ys[j] - ys[i]) / (xs[j] - xs[i])
+                b = (xs[j] * ys[i] - xs[i] * ys[j]) / (xs[j] - xs[i])
+                for k in ks:
+                    err = abs(xs[k] * a + b - ys[k])
+                    if err < best_pair[0]:  # first of equal errors is taken, as pairs and ks are ordered
+                        best_pair = err, i, j, k, a, b
+            err, i, j, k, a, b = best_pair
         w = (calc_chars[i].w + calc_chars[j].w + calc_chars[k].w) / 3
         h = (calc_chars[i].h + calc_chars[j].h + calc_chars[k].h) / 3
         return err, a, b, w, h
 
+    def _calc_approximation_np(self, calc_chars, pairs):
+        '''
+        Same search as _calc_approximation vectorized by numpy, for long calc_chars (large AVG_PERIOD)
+        :return: err, i, j, k, a, b
+        '''
+        xs = np.array([ch.x for ch in calc_chars])
+        ys = np.array([ch.y for ch in calc_chars])
+        i = np.array([p[0] for p in pairs])
+        j = np.array([p[1] for p in pairs])
+        ks = np.array([p[2] for p in pairs])
+        a = (ys[j] - ys[i]) / (xs[j] - xs[i])
+        b = (xs[j] * ys[i] - xs[i] * ys[j]) / (xs[j] - xs[i])
+        errors = np.abs(xs[ks] * a[:, None] + b[:, None] - ys[ks])
+        p, q = np.unravel_index(np.argmin(errors), errors.shape)
+        return float(errors[p, q]), int(i[p]), int(j[p]), int(ks[p, q]), float(a[p]), float(b[p])
+
     def refine(self):
         for i in range(len(self.chars)):
             curr_char = self.chars[i]
@@ -96,6 +140,87 @@ class Line:
                 curr_char.spaces_before = max(0, round(0.5 * ((curr_char.refined_box[0] + curr_char.refined_box[2]) - (prev_char.refined_box[0] + prev_char.refined_box[2])) / step) - 1)
 
 
+class LineIndex:
+    '''
+    Lines being built by boxes_to_lines and their parameters as numpy arrays.
+    Finds lines which can accept a box (see Line.check_and_append) by one vectorized test instead of
+    calling check_and_append of all lines. Parameters must be updated by update() when a line is changed
+    '''
+    MARGIN = 1.001  # threshold is slightly increased, so candidates include all lines check_and_append accepts
+
+    def __init__(self):
+        self.lines = []
+        self.params = np.zeros((3, 64))  # rows: slip, y at x=0, threshold of y distance
+
+    def append(self, line):
+        if len(self.lines) == self.params.shape[1]:
+            self.params = np.concatenate([self.params, np.zeros_like(self.params)], axis=1)
+        self.lines.append(line)
+        self.update(len(self.lines) - 1)
+
+    def update(self, idx):
+        line = self.lines[idx]
+        self.params[:, idx] = (line.slip, line.y - line.slip * line.x, line.h * line.LINE_THR * self.MARGIN)
+
+    def candidates(self, box):
+        '''
+        :return: indexes of lines (in order they were appended) which can accept box. Exact test is
+            Line.check_and_append
+        '''
+        x = (box[0] + box[2])/2
+        y = (box[1] + box[3])/2
+        slip, y0, thr = self.params[:, :len(self.lines)]
+        return np.nonzero(np.abs(slip * x + y0 - y) < thr)[0]
+
+
+class PageArrays:
+    '''
+    Struct-of-arrays view of chars of lines: one row per char, chars of lines[0] first, then of lines[1] etc.
+    Boxes of all chars of the page can be processed by numpy at once and then stored back (see store_refined_boxes)
+    Columns:
+        original_boxes, refined_boxes: float Nx4 (left, top, right, bottom)
+        centers: float Nx2 (x, y of original box)
+        labels, spaces_before: int N
+        line_ids: int N, index of char's line in lines
+        line_starts: int len(lines)+1, chars of lines[i] are rows line_starts[i]:line_starts[i+1]
+    '''
+    __slots__ = ('chars', 'original_boxes', 'refined_boxes', 'centers', 'labels', 'spaces_before', 'line_ids',
+                 'line_starts')
+
+    def __init__(self, lines):
+        self.chars = [ch for ln in lines for ch in ln.chars]
+        line_lengths = [len(ln.chars) for ln in lines]
+        self.line_starts = np.concatenate([[0], np.cumsum(line_lengths, dtype=int)]).astype(int)
+        self.line_ids = np.repeat(np.arange(len(lines)), line_lengths)
+        self.original_boxes = self._boxes_column(attrgetter('original_box'))
+        self.refined_boxes = self._boxes_column(attrgetter('refined_box'))
+        self.centers = (self.original_boxes[:, :2] + self.original_boxes[:, 2:]) / 2
+        self.labels = np.fromiter(map(attrgetter('label'), self.chars), int, len(self.chars))
+        self.spaces_before = np.fromiter(map(attrgetter('spaces_before'), self.chars), int, len(self.chars))
+
+    def _boxes_column(self, get_box):
+        # fromiter of flat sequence is much faster than np.array of list of boxes
+        boxes = chain.from_iterable(map(get_box, self.chars))
+        return np.fromiter(boxes, float, 4 * len(self.chars)).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.chars)
+
+    def store_refined_boxes(self):
+        '''
+        Stores rows of refined_boxes to refined_box of chars (as lists)
+        '''
+        for ch, box in zip(self.chars, self.refined_boxes.tolist()):
+            ch.refined_box = box
+
+    def store_original_boxes(self):
+        '''
+        Stores rows of original_boxes to original_box of chars (as lists)
+        '''
+        for ch, box in zip(self.chars, self.original_boxes.tolist()):
+            ch.original_box = box
+
+
 def get_compareble_y(line1, line2):
     line1, line2, sign = (line1, line2, 1) if line1.length > line2.length else (line2, line1, -1)
     if line2.chars[0].x > line1.middle_x:
@@ -146,9 +271,16 @@ def interpret_line_RU(line, lang, mode = None):
     if not brackets_on:
         brackets_on = defaultdict(int)
 
+    # lt.int_to_letter(label, langs) == lt.letters_table(*langs)[label]
+    sym_letters = lt.letters_table('SYM')
+    num_letters = lt.letters_table('NUM')
+    num_denominator_letters = lt.letters_table('NUM_DENOMINATOR')
+    math_letters = lt.letters_table('MATH_RU')
+    lang_letters = lt.letters_table(lang, 'SYM')
+
     prev_ch = None
     for i, ch in enumerate(line.chars):
-        ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['SYM'])
+        ch.labeling_char = ch.char = sym_letters[ch.label]
         if ch.char == letters.markout_sign:
             ch.char = ''
             if i < len(line.chars)-1:
@@ -169,9 +301,9 @@ def interpret_line_RU(line, lang, mode = None):
             ch.char = None
             if digit_mode:
                 if not frac_mode:
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['NUM'])
+                    ch.labeling_char = ch.char = num_letters[ch.label]
                     if ch.char is None:
-                        ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['NUM_DENOMINATOR'])
+                        ch.labeling_char = ch.char = num_denominator_letters[ch.label]
                         if ch.char is not None:
                             if ch.char == '/0' and prev_ch.labeling_char == '0':
                                 prev_ch.char = ''
@@ -179,14 +311,14 @@ def interpret_line_RU(line, lang, mode = None):
                             else:
                                 ch.labeling_char = ch.char = None #frac_mode = True # TOOD вернуться к отображению дробей
                 else:
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['NUM_DENOMINATOR'])
+                    ch.labeling_char = ch.char = num_denominator_letters[ch.label]
                     if ch.char is not None:
                         ch.char = ch.char[1:]
             if ch.char is None:
                 if ch.spaces_before:
                     math_lang = ''
                 if math_lang:
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, [math_lang.upper()])
+                    ch.labeling_char = ch.char = lt.letters_table(math_lang.upper())[ch.label]
                     if ch.char is not None:
                         if math_lang.isupper():
                             ch.char = ch.char.upper()
@@ -199,20 +331,20 @@ def interpret_line_RU(line, lang, mode = None):
                 if (ch.spaces_before
                     or not prev_ch
                     or prev_ch and not prev_ch.char.isalpha()
-                    or math_mode and not math_lang and lt.int_to_letter(ch.label, ['MATH_RU']) == '..'
+                    or math_mode and not math_lang and math_letters[ch.label] == '..'
                 ):
-                    if lt.int_to_letter(ch.label, ['MATH_RU']) in {'en', 'EN'}:
-                        math_lang = lt.int_to_letter(ch.label, ['MATH_RU'])
+                    if math_letters[ch.label] in {'en', 'EN'}:
+                        math_lang = math_letters[ch.label]
                         ch.char = ''
             if math_mode and ch.char is None:
                 frac_mode = False
-                if not math_lang and (ch.spaces_before or lt.int_to_letter(ch.label, ['MATH_RU']) == '..'):
+                if not math_lang and (ch.spaces_before or math_letters[ch.label] == '..'):
                     # без spaces_before точка и запятая после числа интерпретируется как математический знак :
                     # перед умножением точкой (..) пробел не ставится
-                    ch.labeling_char = ch.char = lt.int_to_letter(ch.label, ['MATH_RU'])
+                    ch.labeling_char = ch.char = math_letters[ch.label]
                     if ch.char is not None:
                         if ch.char == '..':
-                            if i < len(line.chars)-1 and line.chars[i+1].spaces_before == 0 and lt.int_to_letter(line.chars[i+1].label, ['NUM']) is not None:
+                            if i < len(line.chars)-1 and line.chars[i+1].spaces_before == 0 and num_letters[line.chars[i+1].label] is not None:
                                 ch.char = '.'
                             else:
                                 ch.char = '*'
@@ -220,7 +352,7 @@ def interpret_line_RU(line, lang, mode = None):
                             ch.char = ':'
                         ch.spaces_before = max(0, ch.spaces_before-1)
             if ch.char is None:
-                ch.labeling_char = ch.char = lt.int_to_letter(ch.label, [lang, 'SYM'])
+                ch.labeling_char = ch.char = lang_letters[ch.label]
                 if ch.char not in {',', '.', '(', ')'}:
                     math_mode = False
                     math_lang = ''
@@ -316,12 +448,14 @@ def boxes_to_lines(boxes, labels, lang, filter_lonely = True):
     VERTICAL_SPACING_THR = 2.3
 
     boxes = list(zip(boxes, labels))
-    lines = []
+    line_index = LineIndex()
     boxes = sorted(boxes, key=lambda b: b[0][0])
     for b in boxes:
         found_line = None
-        for ln in lines:
+        for line_idx in line_index.candidates(b[0]):
+            ln = line_index.lines[line_idx]
             if ln.check_and_append(box=b[0], label=b[1]):
+                line_index.update(line_idx)
                 # to handle seldom cases when one char can be related to several lines mostly because of errorneous outlined symbols
                 if (found_line and (found_line.chars[-1].x - found_line.chars[-2].x) < (ln.chars[-1].x - ln.chars[-2].x)):
                     ln.chars.pop()
@@ -330,9 +464,9 @@ def boxes_to_lines(boxes, labels, lang, filter_lonely = True):
                         found_line.chars.pop()
                     found_line = ln
         if found_line is None:
-            lines.append(Line(box=b[0], label=b[1]))
+            line_index.append(Line(box=b[0], label=b[1]))
 
-    lines = _sort_lines(lines)
+    lines = _sort_lines(line_index.lines)
     interpret_line_f = interpret_line_funcs[lang]
     interpret_line_mode = None
     prev_line = None
@@ -703,41 +837,42 @@ def transform_image(img, hom):
     img = PIL.Image.fromarray(img)
     return img
 
+def center_shifts(boxes, hom):
+    '''
+    :param boxes: float np.array Nx4 (left, top, right, bottom)
+    :param hom: 3x3 homography or 2x3 affine transformation
+    :return: np.array Nx4, boxes shifts to move their centers according to hom
+    '''
+    pts_transform = cv2.perspectiveTransform if hom.shape[0] == 3 else cv2.transform
+    old_centers = (boxes[:, :2] + boxes[:, 2:4]) / 2
+    new_centers = pts_transform(old_centers[np.newaxis], hom)[0]
+    return np.tile(new_centers - old_centers, 2)
+
+
 def transform_lines(lines, hom):
-    if hom.shape[0] == 3:
-        pts_transform = cv2.perspectiveTransform
-    else:
-        pts_transform = cv2.transform
-    old_centers = np.array([[center_of_char(ch) for ln in lines for ch in ln.chars]])
-    new_centers = pts_transform(old_centers, hom)
-    shifts = (new_centers - old_centers)[0]
-    i = 0
-    for ln in lines:
-        for ch in ln.chars:
-            ch.refined_box[0] += shifts[i, 0]
-            ch.refined_box[1] += shifts[i, 1]
-            ch.refined_box[2] += shifts[i, 0]
-            ch.refined_box[3] += shifts[i, 1]
-            ch.original_box[0] += shifts[i, 0]
-            ch.original_box[1] += shifts[i, 1]
-            ch.original_box[2] += shifts[i, 0]
-            ch.original_box[3] += shifts[i, 1]
-            i += 1
+    page = PageArrays(lines)
+    if len(page):
+        shifts = center_shifts(page.refined_boxes, hom)
+        page.refined_boxes += shifts
+        page.original_boxes += shifts
+        page.store_refined_boxes()
+        page.store_original_boxes()
     return lines
 
 def transform_rects(rects, hom):
+    '''
+    Shifts rects so that their centers are transformed by hom
+    :param rects: np.array Nx4 or more columns, or list of (left, top, right, bottom, ...)
+    :return: np.array for np.array rects, otherwise list of tuples (extra items of rects are kept)
+    '''
     if len(rects):
-        if hom.shape[0] == 3:
-            pts_transform = cv2.perspectiveTransform
+        if isinstance(rects, np.ndarray):
+            rects = rects.astype(float)
+            rects[:, :4] += center_shifts(rects[:, :4], hom)
         else:
-            pts_transform = cv2.transform
-        old_centers = np.array([[((r[2]+r[0])/2, (r[3]+r[1])/2) for r in rects]])
-        new_centers = pts_transform(old_centers, hom)
-        shifts = (new_centers - old_centers)[0].tolist()
-        rects = [
-            (x[0][0] + x[1][0], x[0][1] + x[1][1], x[0][2] + x[1][0], x[0][3] + x[1][1]) + tuple(x[0][4:])
-            for x in zip(rects, shifts)
-        ]
+            boxes = np.array([r[:4] for r in rects], dtype=float)
+            boxes += center_shifts(boxes, hom)
+            rects = [tuple(b) + tuple(r[4:]) for b, r in zip(boxes.tolist(), rects)]
     return rects
 
 
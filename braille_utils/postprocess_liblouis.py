@@ -2,7 +2,6 @@
 #     import sys
 #     sys.path.append(".")
 from pathlib import Path
-import louis
 import local_config
 from braille_utils import label_tools as lt
 
@@ -28,6 +27,7 @@ def interpret_line_liblouis_word_by_word(line, tables, mode):
     Use this function if interpret_line_liblouis_as_a_whole result in text that can't be
     associated with words in line
     """
+    import louis  # imported on first use, it is needed for a few languages only
     braille_word = ""
     curr_word = ""
     init_word_ch_idx = 0
@@ -55,6 +55,7 @@ def interpret_line_liblouis_as_a_whole(line, tables, mode):
     :param mode: not used.
     :return: mode
     """
+    import louis  # imported on first use, it is needed for a few languages only
     whole_braille_string = ""
     word_starts = [0]
     existing_words = []
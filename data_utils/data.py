@@ -9,12 +9,10 @@ import random
 import json
 import PIL
 import numpy as np
-import albumentations
-import albumentations.augmentations.transforms as T
-import albumentations.augmentations.functional as albu_f
 import torch
-import torchvision.transforms.functional as F
 import cv2
+# albumentations is imported on first use: it is slow to import and is not required for inference
+# (see InferencePreprocessor)
 
 from data_utils import dsbi
 from braille_utils import label_tools as lt
@@ -43,6 +41,8 @@ def common_aug(mode, params):
     :param mode: 'train', 'test', 'inference'
     :param params:
     '''
+    import albumentations
+    import albumentations.augmentations.transforms as T
     #aug_params = params.get('augm_params', dict())
     augs_list = []
     assert mode  in {'train', 'debug', 'inference'}
@@ -71,13 +71,86 @@ def common_aug(mode, params):
     return albumentations.ReplayCompose(augs_list, p=1., bbox_params = {'format':'albumentations', 'min_visibility':0.5})
 
 
-class ImagePreprocessor:
+class InferencePreprocessor:
     '''
-    Preprocess image and it's annotation
+    Preprocess image and it's annotation for inference: resizes image to width params.augmentation.img_width_range[0]
+    without augmentations. Uses cv2 only, so albumentations is not required
+    '''
+    def __init__(self, params):
+        self.params = params
+
+    def preprocess_and_augment(self, img, rects=[]):
+        '''
+        Same as ImagePreprocessor.preprocess_and_augment in 'inference' mode
+        :param rects: list of (left, top, right, bottom, ...) in [0,1], are not changed by resize
+        '''
+        aug_img = self.resize_to_width(img, self.params.augmentation.img_width_range[0])
+        aug_bboxes = [tuple(b) for b in rects if
+                      b[0] > 0 and b[0] < 1 and
+                      b[1] > 0 and b[1] < 1 and
+                      b[2] > 0 and b[2] < 1 and
+                      b[3] > 0 and b[3] < 1]
+        return aug_img, aug_bboxes
+
+    def resize_to_width(self, img, new_width):
+        '''
+        Resizes img to new_width keeping aspect ratio. Width and height are rounded up to multiple of 32
+        (as ImagePreprocessor.random_resize_and_stretch without stretch)
+        '''
+        new_height = int(img.shape[0]*new_width/img.shape[1])
+        new_height = ((new_height+31)//32)*32
+        new_width = ((int(new_width)+31)//32)*32
+        if img.shape[:2] == (new_height, new_width):
+            return img
+        return cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+
+    def to_normalized_tensor(self, img, device='cpu'):
+        '''
+        returns image converted to FloatTensor and normalized
+        '''
+        assert img.ndim == 3
+        ten_img = torch.from_numpy(img.transpose((2, 0, 1))).to(device).float()
+        means = ten_img.view(3, -1).mean(dim=1)
+        std = torch.max(ten_img.view(3, -1).std(dim=1), torch.tensor(self.params.data.get('max_std',0)*255).to(ten_img))
+                        #(ten_img.view(3, -1).max(dim=1)[0] - ten_img.view(3, -1).min(dim=1)[0])/6)
+        ten_img = (ten_img - means.view(-1, 1, 1)) / (3*std.view(-1, 1, 1))
+        # decolorize
+        ten_img = ten_img.mean(dim=0).expand(3, -1, -1)
+        return ten_img
+
+    def to_normalized_gray_tensor(self, img, device='cpu'):
+        '''
+        returns 1xHxW FloatTensor equal to a channel of to_normalized_tensor(unify_shape(img)), but without
+        3-channel float copies: per-channel statistics are calculated by uint8 histograms, and normalized channels
+        are averaged as weighted sum accumulated into a single channel
+        '''
+        if img.dtype != np.uint8:
+            return self.to_normalized_tensor(unify_shape(img), device)[:1]
+        channels = [img] if img.ndim == 2 else [img[:, :, c] for c in range(min(img.shape[2], 3))]
+        values = np.arange(256, dtype=np.float64)
+        min_std = self.params.data.get('max_std', 0)*255
+        ten_img = torch.zeros(img.shape[:2], dtype=torch.float32, device=device)
+        bias = 0.
+        for channel in channels:
+            hist = np.bincount(channel.ravel(), minlength=256)
+            n = channel.size
+            mean = (hist * values).sum() / n
+            std = max(np.sqrt((hist * (values - mean)**2).sum() / (n - 1)), min_std)  # unbiased, as torch.std
+            weight = 1. / (3 * std * len(channels)) if std > 0 else 0.
+            channel = np.require(channel, requirements='W')  # torch warns on read-only arrays, copy them
+            ten_img.add_(torch.from_numpy(channel).to(device), alpha=weight)
+            bias += mean * weight
+        ten_img.sub_(bias)
+        return ten_img.unsqueeze(0)
+
+
+class ImagePreprocessor(InferencePreprocessor):
+    '''
+    Preprocess image and it's annotation with augmentations (albumentations)
     '''
     def __init__(self, params, mode):
         assert mode in {'train', 'debug', 'inference'}
-        self.params = params
+        super(ImagePreprocessor, self).__init__(params)
         self.albumentations = common_aug(mode, params)
 
     def preprocess_and_augment(self, img, rects=[]):
@@ -101,6 +174,8 @@ class ImagePreprocessor:
         return aug_img, aug_bboxes
 
     def random_resize_and_stretch(self, img, new_width_range, stretch_limit = 0):
+        import albumentations.augmentations.transforms as T
+        import albumentations.augmentations.functional as albu_f
         new_width_range = T.to_tuple(new_width_range)
         stretch_limit = T.to_tuple(stretch_limit, bias=1)
         new_sz = int(random.uniform(new_width_range[0], new_width_range[1]))
@@ -113,21 +188,6 @@ class ImagePreprocessor:
         new_height = ((new_height+31)//32)*32
         return albu_f.resize(img, height=new_height, width=new_width, interpolation=cv2.INTER_LINEAR)
 
-    def to_normalized_tensor(self, img, device='cpu'):
-        '''
-        returns image converted to FloatTensor and normalized
-        '''
-        assert img.ndim == 3
-        ten_img = torch.from_numpy(img.transpose((2, 0, 1))).to(device).float()
-        means = ten_img.view(3, -1).mean(dim=1)
-        std = torch.max(ten_img.view(3, -1).std(dim=1), torch.tensor(self.params.data.get('max_std',0)*255).to(ten_img))
-                        #(ten_img.view(3, -1).max(dim=1)[0] - ten_img.view(3, -1).min(dim=1)[0])/6)
-        ten_img = (ten_img - means.view(-1, 1, 1)) / (3*std.view(-1, 1, 1))
-        # decolorize
-        ten_img = ten_img.mean(dim=0).expand(3, -1, -1)
-        return ten_img
-
-
 def unify_shape(img):
     if len(img.shape) == 2:
         img = np.tile(img[:, :, np.newaxis], (1, 1, 3))
@@ -0,0 +1,6 @@
+"""
+Types of files accepted for recognition.
+Are kept apart from infer_retinanet to be imported without torch and the model (web app, command line checks)
+"""
+
+VALID_IMAGE_EXTENTIONS = tuple('.jpg,.jpe,.jpeg,.png,.gif,.svg,.bmp,.tiff,.tif,.jfif'.split(','))
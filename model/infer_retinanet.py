@@ -1,14 +1,12 @@
 #!/usr/bin/env python
 # coding: utf-8
 import enum
-try:
-    import fitz
-except:
-    pass
 import os
 import json
 import glob
+import queue
 import sys
+import threading
 import local_config
 sys.path.append(local_config.global_3rd_party)
 from os.path import join
@@ -30,8 +28,9 @@ from model import create_model_retinanet
 import pytorch_retinanet
 import pytorch_retinanet.encoder
 import braille_utils.postprocess as postprocess
+from model.file_types import VALID_IMAGE_EXTENTIONS
+# fitz (PyMuPDF) is imported on first use, when pdf file is processed
 
-VALID_IMAGE_EXTENTIONS = tuple('.jpg,.jpe,.jpeg,.png,.gif,.svg,.bmp,.tiff,.tif,.jfif'.split(','))
 inference_width = 1024
 model_weights = 'model.t7'
 params_fn = join(local_config.data_path, 'weights', 'param.txt')
@@ -42,6 +41,7 @@ cls_thresh = 0.3
 nms_thresh = 0.02
 REFINE_COEFFS = [0.083, 0.092, -0.083, -0.013]  # Коэффициенты (в единицах h символа) для эмпирической коррекции
                         # получившихся размеров, чтобы исправить неточность результатов для последующей разметки
+REFINE_COEFFS_NP = np.array([REFINE_COEFFS])
 
 class OrientationAttempts(enum.IntEnum):
     NONE = 0
@@ -54,11 +54,47 @@ class OrientationAttempts(enum.IntEnum):
     INV_ROT270 = 7
 
 
+# Orientation attempts grouped by input shape: attempts within a group have the same HxW and can be run as one batch
+ORIENTATION_BATCH_GROUPS = [
+    [OrientationAttempts.NONE, OrientationAttempts.ROT180, OrientationAttempts.INV, OrientationAttempts.INV_ROT180],
+    [OrientationAttempts.ROT90, OrientationAttempts.ROT270, OrientationAttempts.INV_ROT90, OrientationAttempts.INV_ROT270],
+]
+
+
+def rotate_to_orientation(np_img, orientation):
+    """
+    Rotates image the same way as model input is rotated for orientation attempt
+    :param orientation: OrientationAttempts.NONE, ROT180, ROT90 or ROT270
+    """
+    if orientation == OrientationAttempts.ROT180:
+        return np_img[::-1, ::-1]
+    if orientation == OrientationAttempts.ROT90:
+        return np.rot90(np_img, 1, (0, 1))
+    if orientation == OrientationAttempts.ROT270:
+        return np.rot90(np_img, 3, (0, 1))
+    assert orientation == OrientationAttempts.NONE, orientation
+    return np_img
+
+
+# Attempts that can be estimated from attempt i-1 (rotated by 180) in 'label_remap' orientation scoring mode
+ROT180_DERIVED_ATTEMPTS = [OrientationAttempts.ROT180, OrientationAttempts.INV_ROT180,
+                           OrientationAttempts.ROT270, OrientationAttempts.INV_ROT270]
+
+
 class BraileInferenceImpl(torch.nn.Module):
-    def __init__(self, params, model, device, label_is_valid, verbose=1):
+    def __init__(self, params, model, device, label_is_valid, verbose=1, batch_orientations=True):
         super(BraileInferenceImpl, self).__init__()
         self.verbose = verbose
         self.device = device
+        self.batch_orientations = batch_orientations
+        # Orientation search with early exit (see find_best_orientation). Disabled if early_exit_ratio is None
+        self.orientation_order = [OrientationAttempts.NONE, OrientationAttempts.ROT180, OrientationAttempts.ROT90, OrientationAttempts.ROT270]
+        self.early_exit_ratio = None
+        self.early_exit_min_valid = 0.
+        # 'exact': run model for all orientation attempts
+        # 'label_remap': estimate ROT180/ROT270 stats from NONE/ROT90 ones (see score_attempts)
+        self.orientation_scoring = 'exact'
+        self.rot180_label_perm = torch.tensor([lt.label_vflip(lt.label_hflip(i)) for i in range(64)]).long()
         if isinstance(model, torch.nn.Module):
             self.model_weights_fn = ""
             self.model = model
@@ -77,17 +113,25 @@ class BraileInferenceImpl(torch.nn.Module):
         self.nms_thresh = nms_thresh
         self.num_classes = [] if not params.data.get('class_as_6pt', False) else [1]*6
 
-    def calc_letter_statistics(self, cls_preds, cls_thresh, orientation_attempts):
-        # type: (List[Tensor], float)->Tuple[int, Tuple[Tensor, Tensor, Tensor]]
-        device = cls_preds[min(orientation_attempts)].device
-        stats = [torch.zeros((1, 64,), device=device)]*8
-        for i, cls_pred in enumerate(cls_preds):
-            if i in orientation_attempts:
-                scores = cls_pred.sigmoid()
-                scores[scores<cls_thresh] = torch.tensor(0.).to(scores.device)
-                stat = scores.sum(1)
-                assert list(stat.shape) == [1, 64]
-                stats[i] = stat
+    def calc_attempt_stat(self, cls_pred, cls_thresh):
+        # type: (Tensor, float)->Tensor
+        """
+        :return: per class sums of scores exceeding cls_thresh for a single orientation attempt, shape [1, 64]
+        """
+        scores = cls_pred.sigmoid()
+        scores[scores<cls_thresh] = torch.tensor(0.).to(scores.device)
+        stat = scores.sum(1)
+        assert list(stat.shape) == [1, 64]
+        return stat
+
+    def calc_letter_statistics(self, stats, orientation_attempts):
+        # type: (List[Tensor], List[int])->Tuple[int, Tuple[Tensor, Tensor, Tensor]]
+        """
+        :param stats: list of 8 results of calc_attempt_stat indexed by OrientationAttempts. Items not in
+            orientation_attempts are ignored
+        """
+        device = stats[min(orientation_attempts)].device
+        stats = [stats[i] if i in orientation_attempts else torch.zeros((1, 64,), device=device) for i in range(8)]
         stat = torch.cat(stats, dim=0)
         valid_mask = self.valid_mask.to(stat.device)
         sum_valid = (stat*valid_mask).sum(1)
@@ -96,9 +140,97 @@ class BraileInferenceImpl(torch.nn.Module):
         best_idx = torch.argmin(err_score/(sum_valid+1)) # эвристика так себе придуманная
         return best_idx.item(), (err_score, sum_valid, sum_invalid)
 
-    def forward(self, input_tensor, input_tensor_rotated, find_orientation, process_2_sides):
-        # type: (Tensor, Tensor, int)->Tuple[Tensor,Tensor,Tensor,int, Tuple[Tensor, Tensor, Tensor]]
-        t = timeit.default_timer()
+    def forward_attempts(self, input_data, attempts, forwarded_attempts, loc_preds, cls_preds):
+        # type: (List[Tensor], List[int], List[int], List[Tensor], List[Tensor])->int
+        """
+        Runs model for attempts not listed in forwarded_attempts yet and adds them to forwarded_attempts
+        :return: number of forward passes
+        """
+        attempts = [i for i in attempts if i not in forwarded_attempts]
+        if not attempts:
+            return 0
+        forwarded_attempts += attempts
+        return self.run_model(input_data, attempts, loc_preds, cls_preds)
+
+    def score_attempts(self, input_data, attempts, derived_attempts, forwarded_attempts, loc_preds, cls_preds, stats):
+        # type: (List[Tensor], List[int], List[int], List[int], List[Tensor], List[Tensor], List[Tensor])->int
+        """
+        Calculates stats[i] (see calc_attempt_stat) for i in attempts.
+        For i in derived_attempts the model is not run: stats[i] is estimated from stats of the attempt rotated by 180
+        (i-1) by remapping labels
+        :return: number of forward passes
+        """
+        to_forward: List[int] = []
+        for i in attempts:
+            src = i - 1 if i in derived_attempts else i
+            if src not in forwarded_attempts and src not in to_forward:
+                to_forward.append(src)
+        n_passes = self.forward_attempts(input_data, to_forward, forwarded_attempts, loc_preds, cls_preds)
+        for i in to_forward:
+            stats[i] = self.calc_attempt_stat(cls_preds[i], self.cls_thresh)
+        for i in attempts:
+            if i in derived_attempts:
+                stats[i] = stats[i - 1][:, self.rot180_label_perm.to(stats[i - 1].device)]
+        return n_passes
+
+    def is_confident_orientation(self, stat):
+        # type: (Tensor)->bool
+        """
+        Checks if orientation attempt with calc_attempt_stat result stat is good enough to stop orientation search
+        """
+        valid_mask = self.valid_mask.to(stat.device)
+        sum_valid = (stat*valid_mask).sum().item()
+        sum_invalid = (stat*(1-valid_mask)).sum().item()
+        return sum_valid >= self.early_exit_min_valid and sum_valid >= self.early_exit_ratio * (sum_invalid + 1)
+
+    def to_model_input(self, batch):
+        # type: (Tensor)->Tensor
+        """
+        Input tensors are 1-channel (see InferencePreprocessor.to_normalized_gray_tensor) up to this point,
+        they are broadcast to 3 channels of the model input without copying
+        """
+        if batch.shape[1] == 1:
+            return batch.expand(-1, 3, -1, -1)
+        return batch
+
+    def run_model(self, input_data, attempts, loc_preds, cls_preds):
+        # type: (List[Tensor], List[int], List[Tensor], List[Tensor])->int
+        """
+        Runs model for input_data[i] for i in attempts and stores results to loc_preds[i], cls_preds[i].
+        input_data[i] can contain several images (see forward_batch).
+        If batch_orientations is set, attempts of the same shape (see ORIENTATION_BATCH_GROUPS) are stacked into
+        a single batch, so at most 2 forward passes are done.
+        :return: number of forward passes
+        """
+        n_passes = 0
+        if not self.batch_orientations:
+            for i in attempts:
+                loc_preds[i], cls_preds[i] = self.model(self.to_model_input(input_data[i]))
+                n_passes += 1
+            return n_passes
+        for group in ORIENTATION_BATCH_GROUPS:
+            group_attempts = [i for i in group if i in attempts]
+            if not group_attempts:
+                continue
+            if len(group_attempts) == 1:
+                batch = input_data[group_attempts[0]]
+            else:
+                batch = torch.cat([input_data[i] for i in group_attempts], dim=0)
+            loc_pred, cls_pred = self.model(self.to_model_input(batch))
+            n_passes += 1
+            offset = 0
+            for i in group_attempts:
+                n = input_data[i].shape[0]
+                loc_preds[i] = loc_pred[offset:offset+n]
+                cls_preds[i] = cls_pred[offset:offset+n]
+                offset += n
+        return n_passes
+
+    def make_input_data(self, input_tensor, input_tensor_rotated, find_orientation, process_2_sides):
+        # type: (Tensor, Tensor, int, int)->Tuple[List[int], List[Tensor]]
+        """
+        :return: orientation_attempts, input_data: list of 8 model inputs indexed by OrientationAttempts
+        """
         orientation_attempts = [OrientationAttempts.NONE]
         if find_orientation:
             orientation_attempts += [OrientationAttempts.ROT180, OrientationAttempts.ROT90, OrientationAttempts.ROT270]
@@ -120,49 +252,201 @@ class BraileInferenceImpl(torch.nn.Module):
                 input_data[OrientationAttempts.INV_ROT180] = torch.flip(-input_data[OrientationAttempts.ROT180], [3])
                 input_data[OrientationAttempts.INV_ROT90] = torch.flip(-input_data[OrientationAttempts.ROT90], [3])
                 input_data[OrientationAttempts.INV_ROT270] = torch.flip(-input_data[OrientationAttempts.ROT270], [3])
+        return orientation_attempts, input_data
+
+    def select_orientation(self, stats, evaluated_attempts, find_orientation):
+        # type: (List[Tensor], List[int], int)->Tuple[int, Tuple[Tensor, Tensor, Tensor]]
+        """
+        :return: best_idx (INV attempts are reduced to corresponding non-inverted ones), err_score
+        """
+        if find_orientation:
+            # early_exit_ratio >= 1 guarantees that the confident attempt is preferred to not evaluated ones
+            best_idx, err_score = self.calc_letter_statistics(stats, evaluated_attempts)
+        else:
+            best_idx, err_score = OrientationAttempts.NONE, (torch.tensor([0.]),torch.tensor([0.]),torch.tensor([0.]))
+        if best_idx in [OrientationAttempts.INV, OrientationAttempts.INV_ROT180, OrientationAttempts.INV_ROT90, OrientationAttempts.INV_ROT270]:
+            best_idx -= 2
+        return best_idx, err_score
+
+    def find_best_orientation(self, input_tensor, input_tensor_rotated, find_orientation, process_2_sides):
+        # type: (Tensor, Tensor, int, int)->Tuple[int, Tuple[Tensor, Tensor, Tensor], List[Tensor], List[Tensor], List[Tensor], int]
+        """
+        Runs model for all orientation attempts and selects the best one.
+        If orientation_scoring is 'label_remap', ROT180 and ROT270 attempts are scored without running the model.
+        If early_exit_ratio is set, orientations are evaluated in orientation_order until a confident one is found
+        (see is_confident_orientation).
+        :return: best_idx (INV attempts are reduced to corresponding non-inverted ones), err_score,
+            input_data, loc_preds, cls_preds (lists of 8 items indexed by OrientationAttempts),
+            n_skipped: number of orientation attempts skipped due to early exit
+        """
+        t = timeit.default_timer()
+        orientation_attempts, input_data = self.make_input_data(input_tensor, input_tensor_rotated,
+                                                                find_orientation, process_2_sides)
         loc_preds: List[Tensor] = [torch.tensor(0)]*8
         cls_preds: List[Tensor] = [torch.tensor(0)]*8
         if self.verbose >= 2:
             print("        forward.prepare", timeit.default_timer() - t)
             t = timeit.default_timer()
-        for i, input_data_i in enumerate(input_data):
-            if i in orientation_attempts:
-                loc_pred, cls_pred = self.model(input_data_i)
-                loc_preds[i] = loc_pred
-                cls_preds[i] = cls_pred
-        if self.verbose >= 2:
-            print("        forward.model", timeit.default_timer() - t)
-            t = timeit.default_timer()
+        stats: List[Tensor] = [torch.tensor(0)]*8
+        forwarded_attempts: List[int] = []
         if find_orientation:
-            best_idx, err_score = self.calc_letter_statistics(cls_preds, self.cls_thresh, orientation_attempts)
+            derived_attempts: List[int] = []
+            if self.orientation_scoring == 'label_remap':
+                derived_attempts = [i for i in orientation_attempts if i in ROT180_DERIVED_ATTEMPTS]
+            if self.early_exit_ratio is not None:
+                # evaluate orientations one by one (together with INV pair) and stop when one of them is confident enough
+                units = [[i for i in (orientation, orientation + 2) if i in orientation_attempts]
+                         for orientation in self.orientation_order]
+            else:
+                units = [orientation_attempts]
+            evaluated_attempts: List[int] = []
+            n_passes = 0
+            for unit_attempts in units:
+                n_passes += self.score_attempts(input_data, unit_attempts, derived_attempts, forwarded_attempts,
+                                                loc_preds, cls_preds, stats)
+                evaluated_attempts += unit_attempts
+                if self.early_exit_ratio is not None:
+                    if any([self.is_confident_orientation(stats[i]) for i in unit_attempts]):
+                        break
         else:
-            best_idx, err_score = OrientationAttempts.NONE, (torch.tensor([0.]),torch.tensor([0.]),torch.tensor([0.]))
+            evaluated_attempts = orientation_attempts
+            n_passes = self.forward_attempts(input_data, orientation_attempts, forwarded_attempts, loc_preds, cls_preds)
+        n_skipped = len(orientation_attempts) - len(evaluated_attempts)
+        if self.verbose >= 2:
+            print("        forward.model", n_passes, n_skipped, timeit.default_timer() - t)
+            t = timeit.default_timer()
+        best_idx, err_score = self.select_orientation(stats, evaluated_attempts, find_orientation)
         if self.verbose >= 2 and self.device != 'cpu':
             torch.cuda.synchronize(self.device)
 
-        if best_idx in [OrientationAttempts.INV, OrientationAttempts.INV_ROT180, OrientationAttempts.INV_ROT90, OrientationAttempts.INV_ROT270]:
-            best_idx -= 2
+        # stats of the selected attempt could be derived by label remapping, so it may be not run yet
+        n_passes_best = self.forward_attempts(input_data, [best_idx, best_idx + 2] if process_2_sides else [best_idx],
+                                              forwarded_attempts, loc_preds, cls_preds)
         if self.verbose >= 2:
-            print("        forward.calc_letter_statistics", timeit.default_timer() - t)
-            t = timeit.default_timer()
-        h,w = input_data[best_idx].shape[2:]
-        boxes, labels, scores = self.encoder.decode(loc_preds[best_idx][0].cpu().data,
-                                                    cls_preds[best_idx][0].cpu().data, (w,h),
+            print("        forward.calc_letter_statistics", n_passes_best, timeit.default_timer() - t)
+        return best_idx, err_score, input_data, loc_preds, cls_preds, n_skipped
+
+    def anchor_centers_y(self, w, h):
+        # type: (int, int)->Tensor
+        """
+        :return: y of anchor centers for model input size (w, h), in the order of model output
+        """
+        return self.encoder._get_anchor_boxes(torch.Tensor([w, h]))[:, 1]
+
+    def decode(self, loc_pred, cls_pred, w, h):
+        # type: (Tensor, Tensor, int, int)->Tuple[Tensor, Tensor, Tensor]
+        """
+        Decodes model output for a single image of input size (w, h)
+        :return: boxes, labels, scores
+        """
+        boxes, labels, scores = self.encoder.decode(loc_pred.cpu().data, cls_pred.cpu().data, (w,h),
                                                     cls_thresh = self.cls_thresh, nms_thresh = self.nms_thresh,
                                                     num_classes=self.num_classes)
         if len(self.num_classes) > 1:
             labels = torch.tensor([lt.label010_to_int([str(s.item()+1) for s in lbl101]) for lbl101 in labels])
+        return boxes, labels, scores
+
+    def forward(self, input_tensor, input_tensor_rotated, find_orientation, process_2_sides):
+        # type: (Tensor, Tensor, int, int)->Tuple[Tensor,Tensor,Tensor,int, Tuple[Tensor, Tensor, Tensor], Tensor,Tensor,Tensor, int]
+        best_idx, err_score, input_data, loc_preds, cls_preds, n_skipped = self.find_best_orientation(
+            input_tensor, input_tensor_rotated, find_orientation, process_2_sides)
+        t = timeit.default_timer()
+        h,w = input_data[best_idx].shape[2:]
+        boxes, labels, scores = self.decode(loc_preds[best_idx][0], cls_preds[best_idx][0], w, h)
         if process_2_sides:
-            boxes2, labels2, scores2 = self.encoder.decode(loc_preds[best_idx+2][0].cpu().data,
-                                                           cls_preds[best_idx+2][0].cpu().data, (w, h),
-                                                           cls_thresh=self.cls_thresh, nms_thresh=self.nms_thresh,
-                                                           num_classes=self.num_classes)
+            boxes2, labels2, scores2 = self.decode(loc_preds[best_idx+2][0], cls_preds[best_idx+2][0], w, h)
         else:
             boxes2, labels2, scores2 = None, None, None
         if self.verbose >= 2:
             print("        forward.decode", timeit.default_timer() - t)
             t = timeit.default_timer()
-        return boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2
+        return boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2, n_skipped
+
+    def forward_batch(self, input_tensors, input_tensors_rotated, find_orientation, process_2_sides):
+        # type: (List[Tensor], List[Tensor], int, int)->List[Tuple[Tensor,Tensor,Tensor,int, Tuple[Tensor, Tensor, Tensor], Tensor,Tensor,Tensor, int]]
+        """
+        Same as forward for several images of the same width, processed as one batch.
+        Images are padded at the bottom to the max height of the batch, detections in the padding are dropped.
+        Early exit (early_exit_ratio) is not applied: all orientation attempts are evaluated for all images
+        :return: list of forward results, one per image
+        """
+        t = timeit.default_timer()
+        n_images = len(input_tensors)
+        orientation_attempts: List[int] = []
+        images_input_data: List[List[Tensor]] = []
+        for input_tensor, input_tensor_rotated in zip(input_tensors, input_tensors_rotated):
+            orientation_attempts, image_input_data = self.make_input_data(input_tensor, input_tensor_rotated,
+                                                                          find_orientation, process_2_sides)
+            images_input_data.append(image_input_data)
+        heights = [[0]*8 for _ in range(n_images)]
+        input_data: List[Tensor] = [torch.tensor(0)]*8
+        for i in orientation_attempts:
+            assert len(set([d[i].shape[3] for d in images_input_data])) == 1, "images of different width"
+            max_h = max([d[i].shape[2] for d in images_input_data])
+            for b, d in enumerate(images_input_data):
+                heights[b][i] = d[i].shape[2]
+            input_data[i] = torch.cat([torch.nn.functional.pad(d[i], [0, 0, 0, max_h - d[i].shape[2]])
+                                       for d in images_input_data], dim=0)
+        loc_preds: List[Tensor] = [torch.tensor(0)]*8
+        cls_preds: List[Tensor] = [torch.tensor(0)]*8
+        if self.verbose >= 2:
+            print("        forward_batch.prepare", n_images, timeit.default_timer() - t)
+            t = timeit.default_timer()
+
+        derived_attempts: List[int] = []
+        if find_orientation and self.orientation_scoring == 'label_remap':
+            derived_attempts = [i for i in orientation_attempts if i in ROT180_DERIVED_ATTEMPTS]
+        forwarded_attempts = [i for i in orientation_attempts if i not in derived_attempts]
+        n_passes = self.run_model(input_data, forwarded_attempts, loc_preds, cls_preds)
+        best_attempts: List[Tuple[int, Tuple[Tensor, Tensor, Tensor]]] = []
+        for b in range(n_images):
+            stats: List[Tensor] = [torch.tensor(0)]*8
+            if find_orientation:
+                for i in forwarded_attempts:
+                    cls_pred = cls_preds[i][b:b+1]
+                    h, w = input_data[i].shape[2:]
+                    if h != heights[b][i]:
+                        # anchors in the padding are excluded, so stats are the same as in forward
+                        in_image = self.anchor_centers_y(w, h) < heights[b][i]
+                        cls_pred = cls_pred[:, in_image.to(cls_pred.device)]
+                    stats[i] = self.calc_attempt_stat(cls_pred, self.cls_thresh)
+                for i in derived_attempts:
+                    stats[i] = stats[i - 1][:, self.rot180_label_perm.to(stats[i - 1].device)]
+            best_attempts.append(self.select_orientation(stats, orientation_attempts, find_orientation))
+        # selected attempts could be estimated by label remapping only
+        images_preds: Dict[Tuple[int, int], Tuple[Tensor, Tensor]] = dict()  # (b, attempt) -> loc_pred, cls_pred
+        for i in derived_attempts:
+            images_to_run = [b for b, (best_idx, _) in enumerate(best_attempts)
+                             if i == best_idx or (process_2_sides and i == best_idx + 2)]
+            if images_to_run:
+                loc_pred, cls_pred = self.model(self.to_model_input(input_data[i][images_to_run]))
+                n_passes += 1
+                for j, b in enumerate(images_to_run):
+                    images_preds[(b, i)] = (loc_pred[j], cls_pred[j])
+        if self.verbose >= 2:
+            print("        forward_batch.model", n_passes, timeit.default_timer() - t)
+            t = timeit.default_timer()
+
+        results = []
+        for b, (best_idx, err_score) in enumerate(best_attempts):
+            decoded = []
+            for i in ([best_idx, best_idx + 2] if process_2_sides else [best_idx]):
+                if (b, i) in images_preds:
+                    loc_pred, cls_pred = images_preds[(b, i)]
+                else:
+                    loc_pred, cls_pred = loc_preds[i][b], cls_preds[i][b]
+                h, w = input_data[i].shape[2:]
+                boxes, labels, scores = self.decode(loc_pred, cls_pred, w, h)
+                if h != heights[b][i]:
+                    in_image = (boxes[:, 1] + boxes[:, 3]) / 2 < heights[b][i]
+                    boxes, labels, scores = boxes[in_image], labels[in_image], scores[in_image]
+                decoded.append((boxes, labels, scores))
+            boxes, labels, scores = decoded[0]
+            boxes2, labels2, scores2 = decoded[1] if process_2_sides else (None, None, None)
+            results.append((boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2, 0))
+        if self.verbose >= 2:
+            print("        forward_batch.decode", timeit.default_timer() - t)
+        return results
 
 
 class BrailleInference:
@@ -174,8 +458,50 @@ class BrailleInference:
     DRAW_FULL_CHARS = 4
 
     def __init__(self, params_fn=params_fn, model_weights_fn=model_weights_fn, create_script = None,
-                 verbose=1, inference_width=inference_width, device=device):
+                 verbose=1, inference_width=inference_width, device=device, batch_orientations=True,
+                 orientation_probe_width=None, verify_orientation_probe=False,
+                 orientation_order=None, early_exit_ratio=None, early_exit_min_valid=50.,
+                 orientation_scoring='exact', max_batch_size=1, batch_height_step=256, page_workers=0,
+                 jpeg_draft=True, rotate_resized=True):
+        """
+        :param batch_orientations: run orientation attempts of the same shape as one batch (see BraileInferenceImpl.run_model)
+        :param orientation_probe_width: if set, orientation is found on a copy of the image downscaled to this width
+            and only the selected orientation is processed at inference_width
+        :param verify_orientation_probe: also find orientation at inference_width and count probe disagreements
+            in orientation_probe_stats (for measurements only, it cancels the speedup of the probe)
+        :param orientation_order: order in which orientations are evaluated when early exit is on,
+            list of OrientationAttempts.NONE, ROT180, ROT90, ROT270. Default is [NONE, ROT180, ROT90, ROT270]
+        :param early_exit_ratio: if set, orientation search stops at the first orientation where sum of valid letter
+            scores is at least early_exit_ratio times sum of invalid ones (+1). Must be >= 1. Remaining attempts are
+            skipped, their number is returned in results_dict['skipped_attempts']
+        :param early_exit_min_valid: min. sum of valid letter scores for the early exit
+        :param orientation_scoring: 'exact' - run model for every orientation attempt, 'label_remap' - estimate
+            ROT180 and ROT270 letter statistics from NONE and ROT90 ones by remapping labels (rotation by 180 maps
+            a braille symbol to another one), so model runs for half of attempts. See validate_retinanet for comparison
+        :param max_batch_size: max. number of images processed by model as one batch by run_batch,
+            process_dir_and_save and process_archive_and_save
+        :param batch_height_step: images are batched together if their widths are equal and heights at model input
+            differ by less than batch_height_step. Images are padded to the max height of the batch
+        :param page_workers: number of recognition threads of process_archive_and_save and process_pdf_and_save.
+            If > 0, pages are decoded ahead by a reader thread, recognized by page_workers threads and saved in order
+            (see process_pages_pipelined). 0 - pages are processed one after another
+        :param jpeg_draft: decode JPEG files at reduced size (see set_draft_mode)
+        :param rotate_resized: make model input for attempts rotated by 90 from resized image, so full resolution
+            image is resized once (see make_input). False - rotated full resolution image is resized again
+        """
         self.verbose = verbose
+        self.orientation_probe_width = orientation_probe_width
+        self.verify_orientation_probe = verify_orientation_probe
+        self.orientation_probe_stats = {'probes': 0, 'verified': 0, 'disagreements': 0}
+        self.orientation_probe_stats_lock = threading.Lock()  # stats are updated by page_workers threads
+        assert max_batch_size >= 1, max_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_height_step = batch_height_step
+        assert page_workers >= 0, page_workers
+        self.page_workers = page_workers
+        self.inference_width = inference_width
+        self.jpeg_draft = jpeg_draft
+        self.rotate_resized = rotate_resized
         if not torch.cuda.is_available() and device != 'cpu':
             print('CUDA not availabel. CPU is used')
             device = 'cpu'
@@ -188,14 +514,20 @@ class BrailleInference:
             stretch_limit = 0.0,
             rotate_limit=0,
         )
-        self.preprocessor = data.ImagePreprocessor(params, mode = 'inference')
+        self.preprocessor = data.InferencePreprocessor(params)
+        if orientation_probe_width:
+            probe_params = copy.deepcopy(params)
+            probe_params.augmentation.img_width_range = (orientation_probe_width, orientation_probe_width)
+            self.probe_preprocessor = data.InferencePreprocessor(probe_params)
 
         if isinstance(model_weights_fn, torch.nn.Module):
-            self.impl = BraileInferenceImpl(params, model_weights_fn, device, lt.label_is_valid, verbose=verbose)
+            self.impl = BraileInferenceImpl(params, model_weights_fn, device, lt.label_is_valid, verbose=verbose,
+                                            batch_orientations=batch_orientations)
         else:
             model_script_fn = model_weights_fn + '.pth'
             if create_script != False:
-                self.impl = BraileInferenceImpl(params, model_weights_fn, device, lt.label_is_valid, verbose=verbose)
+                self.impl = BraileInferenceImpl(params, model_weights_fn, device, lt.label_is_valid, verbose=verbose,
+                                                batch_orientations=batch_orientations)
                 if create_script is not None:
                     self.impl = torch.jit.script(self.impl)
                 if isinstance(self.impl, torch.jit.ScriptModule):
@@ -210,34 +542,71 @@ class BrailleInference:
                 if verbose >= 1:
                     print("Model pth loaded")
         self.impl.to(device)
+        if early_exit_ratio is not None:
+            assert early_exit_ratio >= 1, early_exit_ratio
+            self.impl.early_exit_ratio = early_exit_ratio
+            self.impl.early_exit_min_valid = early_exit_min_valid
+        if orientation_order is not None:
+            assert set(orientation_order) == set(self.impl.orientation_order), orientation_order
+            self.impl.orientation_order = list(orientation_order)
+        assert orientation_scoring in ('exact', 'label_remap'), orientation_scoring
+        self.impl.orientation_scoring = orientation_scoring
+
+    def render_pdf_page(self, pg, find_orientation):
+        """
+        Renders fitz page at zoom that gives ~inference_width pixels at model input, so the page image is not
+        rendered at full resolution and downscaled later (or rendered at 72 dpi and upscaled).
+        If find_orientation, page can be rotated by 90, so its smaller side is rendered to inference_width
+        (both sides are not less than inference_width as in set_draft_mode)
+        :return: PIL.Image
+        """
+        import fitz
+        size = min(pg.rect.width, pg.rect.height) if find_orientation else pg.rect.width
+        zoom = self.inference_width / size
+        pdf = pg.getPixmap(matrix=fitz.Matrix(zoom, zoom))
+        cspace = pdf.colorspace
+        if cspace is None:
+            mode = "L"
+        elif cspace.n == 1:
+            mode = "L" if pdf.alpha == 0 else "LA"
+        elif cspace.n == 3:
+            mode = "RGB" if pdf.alpha == 0 else "RGBA"
+        else:
+            mode = "CMYK"
+        return PIL.Image.frombytes(mode, (pdf.width, pdf.height), pdf.samples)
 
     def load_pdf(self, img_fn):
+        """
+        Renders 1st page of pdf file (see process_pdf_and_save for all pages)
+        :return: PIL.Image or None
+        """
         try:
+            import fitz
             pdf_file = fitz.open(img_fn)
-            pg = pdf_file.loadPage(0)
-            pdf = pg.getPixmap()
-            cspace = pdf.colorspace
-            if cspace is None:
-                mode = "L"
-            elif cspace.n == 1:
-                mode = "L" if pdf.alpha == 0 else "LA"
-            elif cspace.n == 3:
-                mode = "RGB" if pdf.alpha == 0 else "RGBA"
-            else:
-                mode = "CMYK"
-            img = PIL.Image.frombytes(mode, (pdf.width, pdf.height), pdf.samples)
-            return img
+            try:
+                return self.render_pdf_page(pdf_file.loadPage(0), find_orientation=True)
+            finally:
+                pdf_file.close()
         except Exception as exc:
             return None
 
+    def set_draft_mode(self, img, find_orientation):
+        """
+        If img is JPEG file not decoded yet, sets draft mode, so PIL decodes it with DCT scaling by 1/2, 1/4 or 1/8
+        to the smallest size not less than needed at model input: width is resized to inference_width, and
+        height too if find_orientation (for attempts rotated by 90). Final resize is done by preprocessor.
+        For 4000x3000 photo it reduces decoding time and memory several times.
+        """
+        if self.jpeg_draft and img.format == 'JPEG':
+            img.draft(img.mode, (self.inference_width, self.inference_width if find_orientation else 1))
+        return img
 
-    def run(self, img, lang, draw_refined, find_orientation, process_2_sides, align_results, repeat_on_aligned=True, gt_rects=[]):
+    def load_image(self, img, find_orientation=True):
         """
         :param img: can be 1) PIL.Image 2) filename to image (.jpg etc.) or .pdf file
+        :param find_orientation: is used to select JPEG decoding size (see set_draft_mode)
+        :return: PIL.Image or None if img can't be loaded
         """
-        if gt_rects:
-            assert find_orientation == False, "gt_rects можно передавать только если ориентация задана"
-        t = timeit.default_timer()
         if not isinstance(img, PIL.Image.Image):
             try:
                 if Path(img).suffix=='.pdf':
@@ -246,6 +615,31 @@ class BrailleInference:
                     img = PIL.Image.open(img)
             except Exception as e:
                 return None
+        if img is not None:
+            self.set_draft_mode(img, find_orientation)
+        return img
+
+    def copy_first_pass_results(self, results_dict, results_dict0):
+        """
+        Copies orientation and alignment info found at the 1st pass of repeat_on_aligned mode to results_dict
+        """
+        results_dict['best_idx'] = results_dict0['best_idx']
+        results_dict['err_scores'] = results_dict0['err_scores']
+        results_dict['homography'] = results_dict0['homography']
+        results_dict['skipped_attempts'] = results_dict0['skipped_attempts']
+        if 'orientation_probe' in results_dict0:
+            results_dict['orientation_probe'] = results_dict0['orientation_probe']
+
+    def run(self, img, lang, draw_refined, find_orientation, process_2_sides, align_results, repeat_on_aligned=True, gt_rects=[]):
+        """
+        :param img: can be 1) PIL.Image 2) filename to image (.jpg etc.) or .pdf file
+        """
+        if gt_rects:
+            assert find_orientation == False, "gt_rects можно передавать только если ориентация задана"
+        t = timeit.default_timer()
+        img = self.load_image(img, find_orientation)
+        if img is None:
+            return None
         if self.verbose >= 2:
             print("run.reading image", timeit.default_timer() - t)
             # img.save(Path(results_dir) / 'original.jpg')
@@ -262,9 +656,7 @@ class BrailleInference:
             results_dict = self.run_impl(results_dict0['image'], lang, draw_refined, find_orientation=False,
                                          process_2_sides=process_2_sides, align=False, draw=True,
                                          gt_rects=results_dict0['gt_rects'])
-            results_dict['best_idx'] = results_dict0['best_idx']
-            results_dict['err_scores'] = results_dict0['err_scores']
-            results_dict['homography'] = results_dict0['homography']
+            self.copy_first_pass_results(results_dict, results_dict0)
         else:
             results_dict = self.run_impl(img, lang, draw_refined, find_orientation,
                                          process_2_sides=process_2_sides, align=align_results, draw=True, gt_rects=gt_rects)
@@ -274,6 +666,42 @@ class BrailleInference:
             print("run.run_impl", timeit.default_timer() - t)
         return results_dict
 
+    def run_batch(self, images, lang, draw_refined, find_orientation, process_2_sides, align_results, repeat_on_aligned=True):
+        """
+        Same as run for several images. Images of the same width and of similar height (see batch_height_step)
+        are processed by the model as batches of up to max_batch_size images (see BraileInferenceImpl.forward_batch)
+        :param images: list of images, see run
+        :return: list of results_dict (see run), None for images that can't be loaded
+        """
+        t = timeit.default_timer()
+        images = [self.load_image(img, find_orientation) for img in images]
+        loaded = [i for i, img in enumerate(images) if img is not None]
+        imgs = [images[i] for i in loaded]
+        if self.verbose >= 2:
+            print("run_batch.reading images", len(imgs), timeit.default_timer() - t)
+            t = timeit.default_timer()
+        if repeat_on_aligned and not process_2_sides:
+            results_dicts0 = self.run_impl_batch(imgs, lang, draw_refined, find_orientation,
+                                                 process_2_sides=False, align=True, draw=False)
+            if self.verbose >= 2:
+                print("run_batch.run_impl_1", timeit.default_timer() - t)
+                t = timeit.default_timer()
+            results_dicts = self.run_impl_batch([r['image'] for r in results_dicts0], lang, draw_refined,
+                                                find_orientation=False, process_2_sides=process_2_sides,
+                                                align=False, draw=True,
+                                                gt_rects_list=[r['gt_rects'] for r in results_dicts0])
+            for results_dict, results_dict0 in zip(results_dicts, results_dicts0):
+                self.copy_first_pass_results(results_dict, results_dict0)
+        else:
+            results_dicts = self.run_impl_batch(imgs, lang, draw_refined, find_orientation,
+                                                process_2_sides=process_2_sides, align=align_results, draw=True)
+        if self.verbose >= 2:
+            print("run_batch.run_impl", timeit.default_timer() - t)
+        results = [None] * len(images)
+        for i, results_dict in zip(loaded, results_dicts):
+            results[i] = results_dict
+        return results
+
 
     # def refine_boxes(self, boxes):
     #     """
@@ -292,42 +720,167 @@ class BrailleInference:
         :param boxes:
         :return:
         """
-        for ln in lines:
-            for ch in ln.chars:
-                h = ch.refined_box[3] - ch.refined_box[1]
-                coefs = np.array(REFINE_COEFFS)
-                deltas = h * coefs
-                ch.refined_box = (np.array(ch.refined_box) + deltas).tolist()
-
-    def run_impl(self, img, lang, draw_refined, find_orientation, process_2_sides, align, draw, gt_rects=[]):
-        t = timeit.default_timer()
-        np_img = np.asarray(img)
-        if (len(np_img.shape) > 2 and np_img.shape[2] < 3):  # grayscale -> reduce dim
-            np_img = np_img[:,:,0]
-        aug_img, aug_gt_rects = self.preprocessor.preprocess_and_augment(np_img, gt_rects)
-        aug_img = data.unify_shape(aug_img)
-        input_tensor = self.preprocessor.to_normalized_tensor(aug_img, device=self.impl.device)
-        input_tensor_rotated = torch.tensor(0).to(self.impl.device)
+        page = postprocess.PageArrays(lines)
+        boxes = page.refined_boxes
+        boxes += (boxes[:, 3:4] - boxes[:, 1:2]) * REFINE_COEFFS_NP
+        page.store_refined_boxes()
 
+    def make_input(self, np_img, preprocessor, find_orientation, gt_rects=[]):
+        """
+        Resizes np_img using preprocessor and converts it (and its copy rotated by 90 if find_orientation) to model input.
+        Both images are resized to width of model input. If rotate_resized, np_img is resized once to the larger
+        of two scales (the scale of rotated image for landscape np_img), and the other image is made from
+        this resized one by rotation and downscaling
+        :return: aug_img, aug_gt_rects, input_tensor, aug_img_rot, input_tensor_rotated
+        """
+        # np.rot90 returns a view with negative strides, preprocessor returns it as is if no resize is needed,
+        # so results are made contiguous (it copies only such views) to be converted to tensors
         aug_img_rot = None
+        if find_orientation and self.rotate_resized and np_img.shape[1] > np_img.shape[0]:
+            aug_img_rot = np.ascontiguousarray(preprocessor.preprocess_and_augment(np.rot90(np_img, 1, (0,1)))[0])
+            aug_img, aug_gt_rects = preprocessor.preprocess_and_augment(np.rot90(aug_img_rot, -1, (0,1)), gt_rects)
+            aug_img = np.ascontiguousarray(aug_img)
+        else:
+            aug_img, aug_gt_rects = preprocessor.preprocess_and_augment(np_img, gt_rects)
+            if find_orientation:
+                np_img_rot = np.rot90(aug_img if self.rotate_resized else np_img, 1, (0,1))
+                aug_img_rot = np.ascontiguousarray(preprocessor.preprocess_and_augment(np_img_rot)[0])
+        input_tensor = preprocessor.to_normalized_gray_tensor(aug_img, device=self.impl.device)
+        aug_img = data.unify_shape(aug_img)  # 3 channels to draw results
+        input_tensor_rotated = torch.tensor(0).to(self.impl.device)
         if find_orientation:
-            np_img_rot = np.rot90(np_img, 1, (0,1))
-            aug_img_rot = self.preprocessor.preprocess_and_augment(np_img_rot)[0]
+            input_tensor_rotated = preprocessor.to_normalized_gray_tensor(aug_img_rot, device=self.impl.device)
             aug_img_rot = data.unify_shape(aug_img_rot)
-            input_tensor_rotated = self.preprocessor.to_normalized_tensor(aug_img_rot, device=self.impl.device)
+        return aug_img, aug_gt_rects, input_tensor, aug_img_rot, input_tensor_rotated
+
+    def probe_orientation(self, np_img, process_2_sides):
+        """
+        Finds orientation using a copy of np_img downscaled to orientation_probe_width
+        :return: best_idx (NONE, ROT180, ROT90 or ROT270), err_score,
+            full_res_best_idx (orientation found at inference_width if verify_orientation_probe is set, else None),
+            n_skipped (see BraileInferenceImpl.find_best_orientation)
+        """
+        _, _, input_tensor, _, input_tensor_rotated = self.make_input(np_img, self.probe_preprocessor, find_orientation=True)
+        with torch.no_grad():
+            best_idx, err_score, _, _, _, n_skipped = self.impl.find_best_orientation(
+                input_tensor, input_tensor_rotated, find_orientation=True, process_2_sides=process_2_sides)
+        full_res_best_idx = None
+        if self.verify_orientation_probe:
+            _, _, input_tensor, _, input_tensor_rotated = self.make_input(np_img, self.preprocessor, find_orientation=True)
+            with torch.no_grad():
+                full_res_best_idx, _, _, _, _, _ = self.impl.find_best_orientation(
+                    input_tensor, input_tensor_rotated, find_orientation=True, process_2_sides=process_2_sides)
+        with self.orientation_probe_stats_lock:
+            self.orientation_probe_stats['probes'] += 1
+            if full_res_best_idx is not None:
+                self.orientation_probe_stats['verified'] += 1
+                if full_res_best_idx != best_idx:
+                    self.orientation_probe_stats['disagreements'] += 1
+            stats = dict(self.orientation_probe_stats)
+        if self.verbose >= 1 and full_res_best_idx is not None:
+            print("orientation probe: {} full res: {} stats: {}".format(best_idx, full_res_best_idx, stats))
+        return best_idx, err_score, full_res_best_idx, n_skipped
+
+    def prepare_run(self, img, find_orientation, process_2_sides, gt_rects=[]):
+        """
+        Preprocessing stage of run_impl: finds orientation by the probe (if orientation_probe_width is set)
+        and makes model input
+        :return: dict with model input and data for finish_run
+        """
+        np_img = np.asarray(img)
+        if (len(np_img.shape) > 2 and np_img.shape[2] < 3):  # grayscale -> reduce dim
+            np_img = np_img[:,:,0]
+        orientation_probe = None
+        if find_orientation and self.orientation_probe_width:
+            t = timeit.default_timer()
+            orientation_probe = self.probe_orientation(np_img, process_2_sides)
+            np_img = rotate_to_orientation(np_img, orientation_probe[0])
+            find_orientation = False
+            if self.verbose >= 2:
+                print("    run_impl.probe_orientation", timeit.default_timer() - t)
+        aug_img, aug_gt_rects, input_tensor, aug_img_rot, input_tensor_rotated = self.make_input(
+            np_img, self.preprocessor, find_orientation, gt_rects)
+        return {
+            'aug_img': aug_img,
+            'aug_gt_rects': aug_gt_rects,
+            'input_tensor': input_tensor,
+            'aug_img_rot': aug_img_rot,
+            'input_tensor_rotated': input_tensor_rotated,
+            'find_orientation': find_orientation,
+            'orientation_probe': orientation_probe,
+        }
 
+    def run_impl(self, img, lang, draw_refined, find_orientation, process_2_sides, align, draw, gt_rects=[]):
+        t = timeit.default_timer()
+        prepared = self.prepare_run(img, find_orientation, process_2_sides, gt_rects)
         if self.verbose >= 2:
             print("    run_impl.make_batch", timeit.default_timer() - t)
             t = timeit.default_timer()
 
         with torch.no_grad():
-            boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2 = self.impl(
-                input_tensor, input_tensor_rotated, find_orientation=find_orientation, process_2_sides=process_2_sides)
+            impl_results = self.impl(prepared['input_tensor'], prepared['input_tensor_rotated'],
+                                     find_orientation=prepared['find_orientation'], process_2_sides=process_2_sides)
         if self.verbose >= 2:
             print("    run_impl.impl", timeit.default_timer() - t)
+        return self.finish_run(prepared, impl_results, lang, draw_refined, process_2_sides, align, draw)
+
+    def run_impl_batch(self, imgs, lang, draw_refined, find_orientation, process_2_sides, align, draw, gt_rects_list=None):
+        """
+        Same as run_impl for list of images. Model inputs of the same width and height bucket (see batch_height_step)
+        are processed in batches of up to max_batch_size
+        :return: list of results_dict
+        """
+        t = timeit.default_timer()
+        if gt_rects_list is None:
+            gt_rects_list = [[]] * len(imgs)
+        prepared_list = [self.prepare_run(img, find_orientation, process_2_sides, gt_rects)
+                         for img, gt_rects in zip(imgs, gt_rects_list)]
+        buckets = OrderedDict()
+        for i, prepared in enumerate(prepared_list):
+            _, h, w = prepared['input_tensor'].shape
+            key = (w, (h + self.batch_height_step - 1) // self.batch_height_step, prepared['find_orientation'])
+            buckets.setdefault(key, []).append(i)
+        if self.verbose >= 2:
+            print("    run_impl_batch.make_batch", len(imgs), len(buckets), timeit.default_timer() - t)
             t = timeit.default_timer()
 
+        impl_results = [None] * len(imgs)
+        for bucket in buckets.values():
+            for start in range(0, len(bucket), self.max_batch_size):
+                batch = bucket[start:start + self.max_batch_size]
+                with torch.no_grad():
+                    if len(batch) == 1:
+                        prepared = prepared_list[batch[0]]
+                        impl_results[batch[0]] = self.impl(prepared['input_tensor'], prepared['input_tensor_rotated'],
+                                                           find_orientation=prepared['find_orientation'],
+                                                           process_2_sides=process_2_sides)
+                    else:
+                        batch_results = self.impl.forward_batch(
+                            [prepared_list[i]['input_tensor'] for i in batch],
+                            [prepared_list[i]['input_tensor_rotated'] for i in batch],
+                            find_orientation=prepared_list[batch[0]]['find_orientation'],
+                            process_2_sides=process_2_sides)
+                        for i, res in zip(batch, batch_results):
+                            impl_results[i] = res
+        if self.verbose >= 2:
+            print("    run_impl_batch.impl", timeit.default_timer() - t)
+        return [self.finish_run(prepared, res, lang, draw_refined, process_2_sides, align, draw)
+                for prepared, res in zip(prepared_list, impl_results)]
+
+    def finish_run(self, prepared, impl_results, lang, draw_refined, process_2_sides, align, draw):
+        """
+        Postprocessing stage of run_impl
+        :param prepared: result of prepare_run
+        :param impl_results: result of BraileInferenceImpl.forward for prepared input
+        :return: results_dict
+        """
+        t = timeit.default_timer()
+        boxes, labels, scores, best_idx, err_score, boxes2, labels2, scores2, n_skipped = impl_results
+        aug_img, aug_img_rot, aug_gt_rects = prepared['aug_img'], prepared['aug_img_rot'], prepared['aug_gt_rects']
+        orientation_probe = prepared['orientation_probe']
+
         #boxes = self.refine_boxes(boxes)
+        boxes_array = boxes.cpu().numpy().astype(float)  # to transform all boxes at once if align
         boxes = boxes.tolist()
         labels = labels.tolist()
         scores = scores.tolist()
@@ -345,6 +898,9 @@ class BrailleInference:
         aug_img = PIL.Image.fromarray(aug_img if best_idx < OrientationAttempts.ROT90 else aug_img_rot)
         if best_idx in (OrientationAttempts.ROT180, OrientationAttempts.ROT270):
             aug_img = aug_img.transpose(PIL.Image.ROTATE_180)
+        if orientation_probe is not None:
+            # image is already rotated according to the probe
+            best_idx, err_score, full_res_best_idx, n_skipped = orientation_probe
 
         if self.verbose >= 2:
             print("    run_impl.postprocess", timeit.default_timer() - t)
@@ -356,7 +912,7 @@ class BrailleInference:
             hom = postprocess.find_transformation(lines, (aug_img.width, aug_img.height))
             if hom is not None:
                 aug_img = postprocess.transform_image(aug_img, hom)
-                boxes = postprocess.transform_rects(boxes, hom)
+                boxes = postprocess.transform_rects(boxes_array, hom).tolist()
                 lines = postprocess.boxes_to_lines(boxes, labels, lang=lang)
                 self.refine_lines(lines)
                 aug_gt_rects = postprocess.transform_rects(aug_gt_rects, hom)
@@ -372,9 +928,12 @@ class BrailleInference:
             'image': aug_img,
             'best_idx': best_idx,
             'err_scores': list([ten.cpu().data.tolist() for ten in err_score]),
+            'skipped_attempts': n_skipped,
             'gt_rects': aug_gt_rects,
             'homography': hom.tolist() if hom is not None else hom,
         }
+        if orientation_probe is not None:
+            results_dict['orientation_probe'] = {'best_idx': best_idx, 'full_res_best_idx': full_res_best_idx}
 
         if draw:
             results_dict.update(self.draw_results(aug_img, boxes, lines, labels, scores, False, draw_refined))
@@ -503,8 +1062,39 @@ class BrailleInference:
             return None
         if self.verbose >= 2:
             print("run_and_save.run", timeit.default_timer() - t)
-            t = timeit.default_timer()
+        return self.save_run_results(result_dict, img, results_dir, target_stem, extra_info,
+                                     remove_labeled_from_filename, process_2_sides, save_development_info)
+
+    def run_and_save_batch(self, images, results_dirs, target_stems, lang, extra_info, draw_refined,
+                           remove_labeled_from_filename, find_orientation, align_results, process_2_sides,
+                           repeat_on_aligned, save_development_info=True):
+        """
+        Same as run_and_save for several images using run_batch
+        :param results_dirs, target_stems: lists of the same length as images (see run_and_save)
+        :return: list of run_and_save results, one per image
+        """
+        t = timeit.default_timer()
+        result_dicts = self.run_batch(images, lang=lang, draw_refined=draw_refined,
+                                      find_orientation=find_orientation,
+                                      process_2_sides=process_2_sides, align_results=align_results,
+                                      repeat_on_aligned=repeat_on_aligned)
+        if self.verbose >= 2:
+            print("run_and_save_batch.run_batch", len(images), timeit.default_timer() - t)
+        results = []
+        for result_dict, img, results_dir, target_stem in zip(result_dicts, images, results_dirs, target_stems):
+            if result_dict is None:
+                results.append(None)
+                continue
+            results.append(self.save_run_results(result_dict, img, results_dir, target_stem, extra_info,
+                                                 remove_labeled_from_filename, process_2_sides, save_development_info))
+        return results
 
+    def save_run_results(self, result_dict, img, results_dir, target_stem, extra_info,
+                         remove_labeled_from_filename, process_2_sides, save_development_info=True):
+        """
+        Saves result_dict of run(img, ...) to results_dir. See run_and_save for parameters
+        """
+        t = timeit.default_timer()
         os.makedirs(results_dir, exist_ok=True)
         if target_stem is None:
             assert isinstance(img, (str, Path))
@@ -521,9 +1111,12 @@ class BrailleInference:
                     ver = '20200816',
                     best_idx = result_dict['best_idx'],
                     err_scores = result_dict['err_scores'],
+                    skipped_attempts = result_dict['skipped_attempts'],
                     homography = result_dict['homography'],
                     model_weights = self.impl.model_weights_fn,
                 )
+                if 'orientation_probe' in result_dict:
+                    info['orientation_probe'] = result_dict['orientation_probe']
                 if extra_info:
                     info.update(extra_info)
                 json.dump(info, f, sort_keys=False, indent=4)
@@ -555,53 +1148,278 @@ class BrailleInference:
             img_files = list(Path(root_dir).glob(mask))
             img_folders = [os.path.split(fn)[0].replace(str(Path(root_dir)), '')[1:] for fn in img_files]
         result_list = list()
-        for img_file, img_folder in zip(img_files, img_folders):
-            print('processing '+str(img_file))
-            ith_result = self.run_and_save(
-                img_file, os.path.join(results_dir, img_folder), target_stem=None,
+        # pdf files are processed page by page, other files in batches
+        is_pdf = [Path(img_file).suffix.lower() == '.pdf' for img_file in img_files]
+        pdf_files = [(img_file, img_folder) for img_file, img_folder, pdf in zip(img_files, img_folders, is_pdf) if pdf]
+        img_files = [img_file for img_file, pdf in zip(img_files, is_pdf) if not pdf]
+        img_folders = [img_folder for img_folder, pdf in zip(img_folders, is_pdf) if not pdf]
+        for pdf_file, img_folder in pdf_files:
+            print('processing '+str(pdf_file))
+            try:
+                result_list += self.process_pdf_and_save(
+                    pdf_file, os.path.join(results_dir, img_folder),
+                    lang=lang, extra_info=extra_info,
+                    draw_refined=draw_refined,
+                    remove_labeled_from_filename=remove_labeled_from_filename,
+                    find_orientation=find_orientation,
+                    process_2_sides=process_2_sides,
+                    align_results=align_results,
+                    repeat_on_aligned=repeat_on_aligned,
+                    save_development_info=save_development_info)
+            except Exception as e:
+                print('Error processing file: '+ str(pdf_file) + ' ' + str(e))
+        for start in range(0, len(img_files), self.max_batch_size):
+            batch_files = img_files[start:start + self.max_batch_size]
+            batch_folders = img_folders[start:start + self.max_batch_size]
+            for img_file in batch_files:
+                print('processing '+str(img_file))
+            batch_results = self.run_and_save_batch(
+                batch_files, [os.path.join(results_dir, img_folder) for img_folder in batch_folders],
+                target_stems=[None] * len(batch_files),
                 lang=lang, extra_info=extra_info,
                 draw_refined=draw_refined,
-			    remove_labeled_from_filename=remove_labeled_from_filename,
+                remove_labeled_from_filename=remove_labeled_from_filename,
                 find_orientation=find_orientation,
                 process_2_sides=process_2_sides,
                 align_results=align_results,
                 repeat_on_aligned=repeat_on_aligned,
                 save_development_info=save_development_info)
-            if ith_result is None:
-                print('Error processing file: '+ str(img_file))
-                continue
-            result_list += ith_result
+            for img_file, ith_result in zip(batch_files, batch_results):
+                if ith_result is None:
+                    print('Error processing file: '+ str(img_file))
+                    continue
+                result_list += ith_result
         return result_list
 
+    def read_archive_images(self, archive, find_orientation=True):
+        """
+        Decodes images from opened zipfile.ZipFile
+        :param find_orientation: is used to select JPEG decoding size (see set_draft_mode)
+        :return: generator of (entry filename, PIL.Image or None if it can't be decoded) in archive order
+        """
+        for entry in archive.infolist():
+            if not Path(entry.filename).suffix.lower() in VALID_IMAGE_EXTENTIONS:
+                continue
+            try:
+                with archive.open(entry) as file:
+                    img = self.set_draft_mode(PIL.Image.open(file), find_orientation)
+                    img.load()  # file is closed before the image is processed
+            except:
+                img = None
+            yield entry.filename, img
+
     def process_archive_and_save(self, arch_path, results_dir, lang, extra_info, draw_refined,
                     remove_labeled_from_filename, find_orientation, align_results, process_2_sides, repeat_on_aligned,
                     save_development_info=True):
+        """
+        Recognizes images from zip archive and saves results as <archive name>.<image name stem>.*
+        :return: list of save_results results for all images in archive order
+        """
         arch_name = Path(arch_path).name
-        result_list = list()
         with zipfile.ZipFile(arch_path, 'r') as archive:
-            for entry in archive.infolist():
-                with archive.open(entry) as file:
-                    if not Path(file.name).suffix.lower() in VALID_IMAGE_EXTENTIONS:
-                        continue
+            pages = ((name, arch_name + '.' + Path(name).stem, img)
+                     for name, img in self.read_archive_images(archive, find_orientation))
+            return self.process_pages_and_save(pages, arch_path, results_dir, lang, extra_info, draw_refined,
+                                               remove_labeled_from_filename, find_orientation, align_results,
+                                               process_2_sides, repeat_on_aligned, save_development_info)
+
+    def process_pdf_and_save(self, pdf_path, results_dir, lang, extra_info, draw_refined,
+                    remove_labeled_from_filename, find_orientation, align_results, process_2_sides, repeat_on_aligned,
+                    save_development_info=True):
+        """
+        Recognizes all pages of pdf file. Pages are rendered one at a time (see render_pdf_page) while
+        previous ones are recognized, so memory doesn't depend on number of pages.
+        Results are saved as <pdf stem>.p<page number>.* (<pdf stem>.* for 1-page file)
+        :return: list of save_results results for all pages
+        """
+        import fitz
+        stem = Path(pdf_path).stem
+        pdf_file = fitz.open(str(pdf_path))
+        try:
+            n_pages = pdf_file.pageCount
+
+            def pages():
+                for page_no in range(n_pages):
                     try:
-                        img = PIL.Image.open(file)
-                    except:
-                        print('Error processing file: ' + str(entry.filename) + ' in ' + str(arch_path))
-                        continue
-                    ith_result = self.run_and_save(
-                        img, results_dir, target_stem=arch_name + '.'+ Path(entry.filename).stem,
-                        lang=lang, extra_info=extra_info,
-                        draw_refined=draw_refined,
-                        remove_labeled_from_filename=remove_labeled_from_filename,
-                        find_orientation=find_orientation,
-                        process_2_sides=process_2_sides,
-                        align_results=align_results,
-                        repeat_on_aligned=repeat_on_aligned,
-                        save_development_info=save_development_info)
-                    if ith_result is None:
-                        print('Error processing file: ' + str(img_file))
+                        img = self.render_pdf_page(pdf_file.loadPage(page_no), find_orientation)
+                    except Exception as e:
+                        img = None
+                    yield ('page ' + str(page_no + 1), stem if n_pages == 1 else stem + '.p' + str(page_no + 1),
+                           img)
+
+            return self.process_pages_and_save(pages(), pdf_path, results_dir, lang, extra_info, draw_refined,
+                                               remove_labeled_from_filename, find_orientation, align_results,
+                                               process_2_sides, repeat_on_aligned, save_development_info)
+        finally:
+            pdf_file.close()
+
+    def process_pages_and_save(self, pages, source_path, results_dir, lang, extra_info, draw_refined,
+                    remove_labeled_from_filename, find_orientation, align_results, process_2_sides, repeat_on_aligned,
+                    save_development_info=True):
+        """
+        Recognizes and saves pages of archive or pdf file in batches of up to max_batch_size pages.
+        If self.page_workers > 0, pages are processed by process_pages_pipelined
+        :param pages: iterable of (page name for messages, target_stem, PIL.Image or None if page can't be loaded)
+        :param source_path: archive or pdf file, for messages
+        :return: list of save_results results for all pages in order of pages
+        """
+        if self.page_workers > 0:
+            return self.process_pages_pipelined(pages, source_path, results_dir, lang, extra_info, draw_refined,
+                                                remove_labeled_from_filename, find_orientation, align_results,
+                                                process_2_sides, repeat_on_aligned, save_development_info)
+        result_list = list()
+        batch_imgs = []
+        batch_names = []
+        batch_stems = []
+
+        def process_batch():
+            batch_results = self.run_and_save_batch(
+                batch_imgs, [results_dir] * len(batch_imgs),
+                target_stems=batch_stems,
+                lang=lang, extra_info=extra_info,
+                draw_refined=draw_refined,
+                remove_labeled_from_filename=remove_labeled_from_filename,
+                find_orientation=find_orientation,
+                process_2_sides=process_2_sides,
+                align_results=align_results,
+                repeat_on_aligned=repeat_on_aligned,
+                save_development_info=save_development_info)
+            for name, ith_result in zip(batch_names, batch_results):
+                if ith_result is None:
+                    print('Error processing file: ' + str(name) + ' in ' + str(source_path))
+                    continue
+                result_list.extend(ith_result)
+            batch_imgs.clear()
+            batch_names.clear()
+            batch_stems.clear()
+
+        for name, target_stem, img in pages:
+            if img is None:
+                print('Error processing file: ' + str(name) + ' in ' + str(source_path))
+                continue
+            batch_imgs.append(img)
+            batch_names.append(name)
+            batch_stems.append(target_stem)
+            if len(batch_imgs) >= self.max_batch_size:
+                process_batch()
+        if batch_imgs:
+            process_batch()
+        return result_list
+
+    def process_pages_pipelined(self, pages, source_path, results_dir, lang, extra_info, draw_refined,
+                    remove_labeled_from_filename, find_orientation, align_results, process_2_sides, repeat_on_aligned,
+                    save_development_info=True):
+        """
+        Same as process_pages_and_save, but pipelined: a reader thread takes (decodes) pages ahead into a bounded queue,
+        self.page_workers threads recognize them (up to max_batch_size pages at once, see run_batch)
+        and the calling thread saves results in order of pages, so file names are the same as in sequential mode.
+        Not more than read_ahead pages are read and not saved yet, so results waiting for a slow page before them
+        do not accumulate in memory.
+        Exceptions of recognition are raised in the calling thread. All threads are finished on return.
+        """
+        t = timeit.default_timer()
+        read_ahead = 2 * self.page_workers * self.max_batch_size
+        in_flight = threading.Semaphore(read_ahead)  # acquired when a page is read, released when it is saved
+        images_queue = queue.Queue(maxsize=read_ahead)  # (idx, name, target_stem, img), None - no more pages
+        results_queue = queue.Queue(maxsize=read_ahead)  # (idx, name, target_stem, result_dict), None - worker finished
+        stop = threading.Event()  # set when the calling thread exits, other threads stop waiting for queues
+        errors = []
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q, block=True):
+            while not stop.is_set():
+                try:
+                    return q.get(block=block, timeout=0.1 if block else None)
+                except queue.Empty:
+                    if not block:
+                        raise
+            return None
+
+        def reader():
+            try:
+                for idx, (name, target_stem, img) in enumerate(pages):
+                    while not in_flight.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                    if not put(images_queue, (idx, name, target_stem, img)):
+                        return
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for _ in range(self.page_workers):
+                    put(images_queue, None)
+
+        def worker():
+            finished = False
+            while not finished:
+                items = []
+                while len(items) < self.max_batch_size:
+                    try:
+                        item = get(images_queue, block=not items)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        finished = True
+                        break
+                    items.append(item)
+                loaded = [item for item in items if item[3] is not None]
+                try:
+                    result_dicts = self.run_batch([item[3] for item in loaded], lang=lang, draw_refined=draw_refined,
+                                                  find_orientation=find_orientation,
+                                                  process_2_sides=process_2_sides, align_results=align_results,
+                                                  repeat_on_aligned=repeat_on_aligned) if loaded else []
+                except Exception as e:
+                    errors.append(e)
+                    break
+                results = {item[0]: result_dict for item, result_dict in zip(loaded, result_dicts)}
+                for idx, name, target_stem, _ in items:
+                    if not put(results_queue, (idx, name, target_stem, results.get(idx))):
+                        return
+            put(results_queue, None)
+
+        threads = [threading.Thread(target=reader, daemon=True)]
+        threads += [threading.Thread(target=worker, daemon=True) for _ in range(self.page_workers)]
+        for thread in threads:
+            thread.start()
+        result_list = list()
+        pending = dict()
+        next_idx = 0
+        finished_workers = 0
+        try:
+            while finished_workers < self.page_workers:
+                item = results_queue.get()
+                if item is None:
+                    finished_workers += 1
+                    if errors:
+                        raise errors[0]
+                    continue
+                pending[item[0]] = item
+                while next_idx in pending:
+                    _, name, target_stem, result_dict = pending.pop(next_idx)
+                    next_idx += 1
+                    in_flight.release()
+                    if result_dict is None:
+                        print('Error processing file: ' + str(name) + ' in ' + str(source_path))
                         continue
-                    result_list += ith_result
+                    result_list.extend(self.save_run_results(result_dict, None, results_dir, target_stem, extra_info,
+                                                             remove_labeled_from_filename, process_2_sides,
+                                                             save_development_info))
+            if errors:  # reader error
+                raise errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        if self.verbose >= 2:
+            print("process_pages_pipelined", next_idx, timeit.default_timer() - t)
         return result_list
 
 
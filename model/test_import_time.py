@@ -0,0 +1,49 @@
+"""
+Manual test of start up time: measures import of inference and web app modules with python -X importtime
+and checks that heavy optional modules are not imported until they are used.
+Run from the project root: python -m model.test_import_time
+"""
+import os
+import subprocess
+import sys
+import timeit
+
+repeats = 3
+# module to import: (max. import time in seconds, modules that must not be imported)
+targets = {
+    'model.infer_retinanet': (3.0, ('fitz', 'louis', 'albumentations', 'torchvision.transforms.functional')),
+    'web_app.angelina_reader_core': (0.5, ('torch', 'cv2', 'fitz', 'louis', 'albumentations', 'model.infer_retinanet')),
+}
+top_n = 15  # number of slowest modules to print
+
+
+def import_time(module):
+    """
+    Imports module in a new python process with -X importtime
+    :return: wall time of the process (seconds), dict: module -> cumulative import time (seconds)
+    """
+    t = timeit.default_timer()
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                         stderr=subprocess.PIPE, universal_newlines=True, env=os.environ.copy())
+    wall_time = timeit.default_timer() - t
+    assert res.returncode == 0, res.stderr[-2000:]
+    times = dict()
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return wall_time, times
+
+
+for module, (max_time, lazy_modules) in targets.items():
+    results = [import_time(module) for _ in range(repeats)]
+    wall_time, times = min(results, key=lambda r: r[1][module])  # best of repeats
+    print('{}: import {:.3f} s (target {} s), process {:.3f} s'.format(module, times[module], max_time, wall_time))
+    top_level = sorted(((t, name) for name, t in times.items() if '.' not in name), reverse=True)
+    for t, name in top_level[:top_n]:
+        print('    {:.3f} {}'.format(t, name))
+    imported_lazy = [name for name in lazy_modules if name in times]
+    assert not imported_lazy, '{} imports {}'.format(module, imported_lazy)
+    assert times[module] <= max_time, '{} import takes {:.3f} s'.format(module, times[module])
+print('Done')
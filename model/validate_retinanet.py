@@ -31,11 +31,13 @@ datasets = {
 
 lang = 'RU'
 
+import itertools
 import os
 import sys
 import Levenshtein
 from pathlib import Path
 import PIL
+import numpy as np
 import torch
 sys.path.append(r'../..')
 sys.path.append('../NN/RetinaNet')
@@ -525,6 +527,93 @@ def evaluate_accuracy(params_fn, model, device, data_list, do_filter_lonely_rect
         'f1': 2*precision_c*recall_c/(precision_c+recall_c) if precision_c+recall_c != 0 else 0.,
     }
 
+def compare_recognizer_option(recognizer, data_list, attr, values, process_2_sides=False):
+    """
+    Compares orientation found with two values of recognizer option (i.e. orientation_scoring or rotate_resized).
+    Every image and its square crop (its rotated copy needs no resize) are rotated by 0, 90, 180, 270 degrees
+    :param recognizer: infer_retinanet.BrailleInference instance
+    :param data_list:  list of dicts (see prepare_data)
+    :param attr: name of recognizer attribute, can be dotted: 'impl.orientation_scoring'
+    :param values: two values of attr to compare
+    :return: dict: n - number of samples, accuracy - dict: value -> rate of correctly found orientations,
+        agreement - rate of samples where orientations found with both values are the same
+    """
+    expected_idx = {0: infer_retinanet.OrientationAttempts.NONE, 1: infer_retinanet.OrientationAttempts.ROT90,
+                    2: infer_retinanet.OrientationAttempts.ROT180, 3: infer_retinanet.OrientationAttempts.ROT270}
+    *owner_path, attr_name = attr.split('.')
+    owner = recognizer
+    for name in owner_path:
+        owner = getattr(owner, name)
+    prev_value = getattr(owner, attr_name)
+    n = 0
+    n_correct = [0] * len(values)
+    n_agree = 0
+    try:
+        for gt_dict in data_list:
+            img = np.asarray(PIL.Image.open(gt_dict['image_fn']))
+            side = min(img.shape[:2])
+            for sample, k in itertools.product((img, img[:side, :side]), range(4)):
+                rotated_img = PIL.Image.fromarray(np.rot90(sample, k, (0, 1)).copy())
+                found_idx = []
+                for i, value in enumerate(values):
+                    setattr(owner, attr_name, value)
+                    res_dict = recognizer.run(rotated_img,
+                                              lang=lang,
+                                              draw_refined=infer_retinanet.BrailleInference.DRAW_NONE,
+                                              find_orientation=True,
+                                              process_2_sides=process_2_sides,
+                                              align_results=False,
+                                              repeat_on_aligned=False)
+                    found_idx.append(res_dict['best_idx'])
+                    if found_idx[i] == expected_idx[(-k) % 4]:
+                        n_correct[i] += 1
+                if len(set(found_idx)) == 1:
+                    n_agree += 1
+                n += 1
+    finally:
+        setattr(owner, attr_name, prev_value)
+    return {
+        'n': n,
+        'accuracy': {value: n_correct[i] / n if n else 0. for i, value in enumerate(values)},
+        'agreement': n_agree / n if n else 0.,
+    }
+
+def compare_run_batch(recognizer, data_list, process_2_sides=False, height_steps=(0, 10, 50)):
+    """
+    Compares results of recognizer.run and recognizer.run_batch for images of different heights that are batched
+    together (i.e. padded at the bottom). Every image is cropped from the bottom by height_steps pixels
+    :param recognizer: infer_retinanet.BrailleInference instance
+    :param data_list:  list of dicts (see prepare_data)
+    :return: dict: n - number of samples, agreement - rate of samples where orientations found by run and run_batch
+        are the same, max_err_score_diff - max. relative difference of err_scores
+    """
+    params = dict(lang=lang, draw_refined=infer_retinanet.BrailleInference.DRAW_NONE, find_orientation=True,
+                  process_2_sides=process_2_sides, align_results=False, repeat_on_aligned=False)
+    prev_max_batch_size = recognizer.max_batch_size
+    n = 0
+    n_agree = 0
+    max_diff = 0.
+    try:
+        recognizer.max_batch_size = max(prev_max_batch_size, len(height_steps))
+        for gt_dict in data_list:
+            img = np.asarray(PIL.Image.open(gt_dict['image_fn']))
+            samples = [PIL.Image.fromarray(img[:img.shape[0] - step]) for step in height_steps]
+            batch_res = recognizer.run_batch(samples, **params)
+            for sample, res_b in zip(samples, batch_res):
+                res = recognizer.run(sample, **params)
+                if res['best_idx'] == res_b['best_idx']:
+                    n_agree += 1
+                err_scores, err_scores_b = np.array(res['err_scores']), np.array(res_b['err_scores'])
+                max_diff = max(max_diff, float((np.abs(err_scores - err_scores_b) / (np.abs(err_scores) + 1e-6)).max()))
+                n += 1
+    finally:
+        recognizer.max_batch_size = prev_max_batch_size
+    return {
+        'n': n,
+        'agreement': n_agree / n if n else 0.,
+        'max_err_score_diff': max_diff,
+    }
+
 def main(table_like_format):
     # make data list
     for m in models:
@@ -573,6 +662,21 @@ def main(table_like_format):
                       'precision_r: {res[precision_r]:.4}, recall_r: {res[recall_r]:.4} f1_r: {res[f1_r]:.4} '
                       'd_by_doc: {res[d_by_doc]:.4} d_by_char: {res[d_by_char]:.4} '
                       'd_by_char_avg: {res[d_by_char_avg]:.4}'.format(model_weights=model_weights, key=key, res=res))
+            compared_options = []
+            if compare_orientation:  # orientation scoring modes (see BrailleInference)
+                compared_options.append(('impl.orientation_scoring', ('exact', 'label_remap')))
+            if compare_rotation:  # input for attempts rotated by 90 made from resized image or full resolution one
+                compared_options.append(('rotate_resized', (True, False)))
+            for attr, values in compared_options:
+                res = compare_recognizer_option(recognizer, data_list, attr, values)
+                print('{model_weights} {key} {attr}: n: {res[n]} {accuracy} agreement: {res[agreement]:.4}'.format(
+                    model_weights=model_weights, key=key, attr=attr, res=res,
+                    accuracy=' '.join('accuracy {}: {:.4}'.format(v, acc) for v, acc in res['accuracy'].items())))
+            if compare_batch:  # run vs run_batch for images padded in a batch
+                res = compare_run_batch(recognizer, data_list)
+                print('{model_weights} {key} run_batch: n: {res[n]} agreement: {res[agreement]:.4} '
+                      'max_err_score_diff: {res[max_err_score_diff]:.4}'.format(
+                    model_weights=model_weights, key=key, res=res))
 
 if __name__ == '__main__':
     import timeit
@@ -581,6 +685,9 @@ if __name__ == '__main__':
     do_filter_lonely_rects = False
     metrics_for_lines = True  # was False
     show_filtered = False
+    compare_orientation = False  # compare 'exact' and 'label_remap' orientation scoring (see compare_recognizer_option)
+    compare_rotation = False  # compare orientation found with rotate_resized on and off (see compare_recognizer_option)
+    compare_batch = False  # compare run and run_batch results (see compare_run_batch)
     t0 = timeit.default_timer()
     # for thr in (0.5, 0.6, 0.7, 0.8):
     #     postprocess.Line.LINE_THR = thr
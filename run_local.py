@@ -8,7 +8,7 @@ import os
 from pathlib import Path
 
 import local_config
-import model.infer_retinanet as infer_retinanet
+from model.file_types import VALID_IMAGE_EXTENTIONS
 
 model_weights = 'model.t7'
 
@@ -19,17 +19,24 @@ parser.add_argument('results_dir', nargs='?', type=str, help='(Optional) output
 parser.add_argument('-l', '--lang', type=str, default='RU', help='(Optional) Document language (RU, EN, EN2, DE, GR, LV, PL, UZ or UZL). If not specified, is RU')
 parser.add_argument('-o', '--orient', action='store_false', help="Don't find orientation, use original file orientation")
 parser.add_argument('-2', dest='two', action='store_true', help="Process 2 sides")
+parser.add_argument('-w', '--workers', type=int, default=0, help="(Optional) Number of threads recognizing pages of zip or pdf file. 0 - one page at a time. Default is 0")
 
 args = parser.parse_args()
 
 if not Path(args.input).exists():
     print('input file/path does not exist: ' + args.input)
     exit()
+if not Path(args.input).is_dir() and Path(args.input).suffix not in VALID_IMAGE_EXTENTIONS + ('.pdf', '.zip'):
+    print('Incorrect file extention: ' + Path(args.input).suffix + ' . Only images, .pdf and .zip files allowed')
+    exit()
+
+import model.infer_retinanet as infer_retinanet  # after arguments are checked: it loads torch and takes time
 
 recognizer = infer_retinanet.BrailleInference(
     params_fn=os.path.join(local_config.data_path, 'weights', 'param.txt'),
     model_weights_fn=os.path.join(local_config.data_path, 'weights', model_weights),
-    create_script=None)
+    create_script=None,
+    page_workers=args.workers)
 
 if Path(args.input).is_dir():
     results_dir = args.results_dir or args.input
@@ -44,8 +51,10 @@ if Path(args.input).is_dir():
                                     save_development_info=False)
 else:
     results_dir = args.results_dir or Path(args.input).parent
-    if Path(args.input).suffix == '.zip':
-        recognizer.process_archive_and_save(args.input, results_dir,
+    if Path(args.input).suffix in ('.zip', '.pdf'):
+        process_pages_and_save = (recognizer.process_archive_and_save if Path(args.input).suffix == '.zip'
+                                  else recognizer.process_pdf_and_save)
+        process_pages_and_save(args.input, results_dir,
                                                lang=args.lang, extra_info=None,
                                                draw_refined=recognizer.DRAW_NONE,
                                                remove_labeled_from_filename=False,
@@ -54,7 +63,7 @@ else:
                                                process_2_sides=args.two,
                                                repeat_on_aligned=False,
                                                save_development_info=False)
-    elif Path(args.input).suffix in ('.jpg', '.jpe', '.jpeg', '.png', '.gif', '.svg', '.bmp'):
+    else:
         recognizer.run_and_save(args.input, results_dir, target_stem=None,
                                                lang=args.lang, extra_info=None,
                                                draw_refined=recognizer.DRAW_NONE,
@@ -64,7 +73,4 @@ else:
                                                process_2_sides=args.two,
                                                repeat_on_aligned=False,
                                                save_development_info=False)
-    else:
-        print('Incorrect file extention: ' + Path(args.input).suffix + ' . Only images, .pdf and .zip files allowed')
-        exit()
 print('Done. Results are saved in ' + str(results_dir))
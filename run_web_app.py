@@ -1,2 +1,4 @@
 from web_app import angelina_reader_app
-angelina_reader_app.run()
+
+if __name__ == '__main__':  # recognition worker processes are spawned and import this module too
+    angelina_reader_app.run()
@@ -17,12 +17,14 @@ import time
 import json
 import signal
 import sys
+import threading
 import argparse
 from pathlib import Path
 import socket
 
 from .config import Config
-from .angelina_reader_core import AngelinaSolver, VALID_EXTENTIONS, fill_message_headers, send_email
+from .angelina_reader_core import AngelinaSolver, VALID_EXTENTIONS, fill_message_headers, send_email, \
+    release_sqlite_connections
 
 
 def startup_logger():
@@ -61,6 +63,29 @@ def load_user(user_id):
     return core.find_user(id=user_id)
 
 
+@app.teardown_request
+def release_db_connections(exc):
+    release_sqlite_connections()
+
+
+workers_started = False
+workers_lock = threading.Lock()
+
+@app.before_request
+def start_recognition_workers():
+    """
+    Starts recognition workers (see AngelinaSolver.start_workers) once per process with the first request.
+    So they are started for any entry point: run() or WSGI server that imports app, but not in processes
+    that only import this module (i.e. spawned recognition workers)
+    """
+    global workers_started
+    if not workers_started:
+        with workers_lock:
+            if not workers_started:
+                core.start_workers(app.config['RECOGNITION_WORKERS'])
+                workers_started = True
+
+
 @app.route("/", methods=['GET', 'POST'])
 @app.route("/index", methods=['GET', 'POST'])
 @mobile_template('{m/}index.html')
@@ -160,8 +185,15 @@ def results(template):
     results_list = None
     task_id = request.values['task_id']
     if task_id:
-        assert core.is_completed(task_id, timeout=1)
-        results_list = core.get_results(task_id)
+        # request thread is not held for the whole RECOGNITION_TIMEOUT: page is reloaded until results are ready
+        wait_start = float(request.values.get('wait_start') or time.time())
+        time_left = app.config['RECOGNITION_TIMEOUT'] - (time.time() - wait_start)
+        if core.is_completed(task_id, timeout=max(0, min(app.config['RESULTS_WAIT_TIME'], time_left))):
+            results_list = core.get_results(task_id)
+        elif time.time() - wait_start < app.config['RECOGNITION_TIMEOUT']:
+            reload_url = url_for('results', **{**request.values.to_dict(), 'wait_start': wait_start})
+            return (render_template(template.replace('results.html', 'processing.html')), 200,
+                    {'Refresh': '1; url={}'.format(reload_url)})
     if results_list is None:
         flash(
             'Ошибка обработки файла. Возможно, файл имеет неверный формат. Если вы считаете, что это ошибка, пришлите файл по адресу, указанному в низу страцины')
@@ -310,6 +342,7 @@ def run():
     app.jinja_env.cache = {}
     if debug:
         app.config['TEMPLATES_AUTO_RELOAD'] = True
+        app.config['RECOGNITION_WORKERS'] = 0  # in debug mode recognition is done in request threads
         app.run(debug=True, host='0.0.0.0', port=5001)
     else:
         app.run(host='0.0.0.0', threaded=True)
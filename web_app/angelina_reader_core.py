@@ -3,32 +3,45 @@
 """
 Описание интерфейсов между UI и алгоритмическим модулями
 """
+import atexit
+from collections import OrderedDict
+import contextlib
 from datetime import datetime
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
 from email.mime.text import MIMEText
 import email.utils as email_utils
 from enum import Enum
+import functools
 import json
 import hashlib
+import multiprocessing
 import os
 from pathlib import Path
+import queue
 import random
 import smtplib
+import socket
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
 import timeit
 import uuid
+import zipfile
 import werkzeug.datastructures
 
 from .config import Config
-import model.infer_retinanet as infer_retinanet
+from model.file_types import VALID_IMAGE_EXTENTIONS
 from braille_utils import label_tools as lt
 
 MODEL_PATH = Config.MODEL_PATH or Path(__file__).parent.parent
 MODEL_WEIGHTS = 'model.t7'
 
 recognizer = None
+recognizer_lock = threading.Lock()  # recognizer is used by request threads if no worker processes are started
 
 class AngelinaException(Exception):
     def __init__(self, msg_ru, msg_en):
@@ -43,7 +56,7 @@ class TaskState(Enum):
     PROCESSING_DONE = 3
     ERROR = 4
 
-VALID_EXTENTIONS = infer_retinanet.VALID_IMAGE_EXTENTIONS + tuple('.pdf,.zip'.split(','))
+VALID_EXTENTIONS = VALID_IMAGE_EXTENTIONS + tuple('.pdf,.zip'.split(','))
 UNSUPPORTED_ARCHIVE_EXTENTIONS = tuple('.rar'.split(','))
 
 
@@ -55,14 +68,190 @@ def fill_message_headers(msg, to_address, subject):
     msg['Message-Id'] = email_utils.make_msgid(idstring=str(uuid.uuid4()), domain=Config.SMTP_FROM.split('@')[1])
     return msg
 
+class MailSender:
+    """
+    Отправляет письма в фоновом потоке. SMTP сессия сохраняется между письмами (закрывается после idle_timeout
+    секунд без писем), письма, накопившиеся в очереди, отправляются в одной сессии.
+    При ошибке соединения или временной ошибке сервера (4xx) отправка повторяется до max_retries раз
+    с задержкой retry_delay, 2*retry_delay, ... Письма с постоянными ошибками (5xx) не повторяются.
+    """
+    def __init__(self, server=None, port=None, login=None, password=None, use_tls=True,
+                 max_retries=5, retry_delay=1., idle_timeout=60.):
+        self.server = server or Config.SMTP_SERVER
+        self.port = port or Config.SMTP_PORT
+        self.login = login if login is not None else Config.SMTP_FROM
+        self.password = password if password is not None else Config.SMTP_PWD
+        self.use_tls = use_tls
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue()
+        self.connection = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, msg):
+        """
+        Ставит письмо в очередь на отправку и сразу возвращается
+        :param msg: email message or function that returns it. Function is called just before sending, so that
+            large messages are not kept in memory while waiting in the queue
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="mail_sender", daemon=True)
+                self.thread.start()
+        self.queue.put(msg)
+
+    def flush(self, timeout=None):
+        """
+        Ждет отправки писем, поставленных в очередь, в течение timeout секунд (None - без ограничения)
+        :return: True if all messages are processed
+        """
+        t0 = timeit.default_timer()
+        while self.queue.unfinished_tasks:
+            if timeout is not None and timeit.default_timer() - t0 > timeout:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _connect(self):
+        connection = smtplib.SMTP(self.server, int(self.port))
+        if self.use_tls:
+            connection.starttls()
+        if self.password:
+            connection.login(self.login, self.password)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    def _send(self, msg):
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.connection is None:
+                    self.connection = self._connect()
+                self.connection.sendmail(msg['From'], msg['To'].split(';'), msg.as_string())
+                return
+            except smtplib.SMTPRecipientsRefused as e:
+                print("Error sending e-mail to {}: {}".format(msg['To'], str(e)))
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                self._close()
+                if attempt == self.max_retries or getattr(e, 'smtp_code', 0) >= 500:  # 5xx - permanent error
+                    print("Error sending e-mail to {}: {}".format(msg['To'], str(e)))
+                    return
+                time.sleep(self.retry_delay * 2**attempt)
+
+    def _run(self):
+        while True:
+            try:
+                msg = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._close()
+                continue
+            try:
+                if callable(msg):
+                    msg = msg()
+                self._send(msg)
+            except Exception as e:
+                print("Error preparing e-mail: {}".format(str(e)))
+            finally:
+                msg = None
+                self.queue.task_done()
+
+
+mail_sender = MailSender()
+atexit.register(mail_sender.flush, 30)
+
 def send_email(msg):
-    # create server and send
-    server = smtplib.SMTP("{}: {}".format(Config.SMTP_SERVER, Config.SMTP_PORT))
-    server.starttls()
-    server.login(Config.SMTP_FROM, Config.SMTP_PWD)
-    recepients = msg['To'].split(';')
-    server.sendmail(msg['From'], recepients, msg.as_string())
-    server.quit()
+    """
+    Sends msg asynchronously (see MailSender)
+    """
+    mail_sender.send(msg)
+
+
+sqlite_connections = threading.local()  # connections used by the current thread: db path -> connection
+# db path -> list of connections released by finished requests, least recently released paths first.
+# Size is limited by Config.SQLITE_IDLE_PER_DB and Config.SQLITE_IDLE_TOTAL, the oldest connections are closed
+sqlite_idle_connections = OrderedDict()
+sqlite_pool_lock = threading.Lock()
+sqlite_migrated_paths = set()  # db paths which are migrated in this process
+sqlite_migrate_lock = threading.Lock()
+
+def sqlite_connection(db_path, create_queries=(), migrate=None):
+    """
+    Returns sqlite connection to db_path used by the current thread. Takes it from the pool shared by threads
+    (see release_sqlite_connections) or creates it if necessary.
+    New connections use WAL journal mode (readers do not block writer), synchronous=NORMAL and wait for locks
+    up to Config.SQLITE_BUSY_TIMEOUT. Statements are cached by connection, so pooled connections reuse them.
+    :param create_queries: queries to execute if db file does not exist
+    :param migrate: function(con) to update schema of existing db. Is called once per db path in a process
+    """
+    db_path = str(db_path)
+    used = sqlite_connections.__dict__.setdefault('pool', dict())
+    con = used.get(db_path)
+    if con is None:
+        with sqlite_pool_lock:
+            idle = sqlite_idle_connections.get(db_path)
+            con = idle.pop() if idle else None
+            if idle is not None and not idle:
+                del sqlite_idle_connections[db_path]
+        if con is None:
+            con = _open_sqlite_connection(db_path, create_queries, migrate)
+        used[db_path] = con
+    return con
+
+def _open_sqlite_connection(db_path, create_queries, migrate):
+    with sqlite_migrate_lock:
+        new_db = not os.path.isfile(db_path)
+        # connection can be used by other threads after release_sqlite_connections, but by one thread at a time
+        con = sqlite3.connect(db_path, timeout=Config.SQLITE_BUSY_TIMEOUT, cached_statements=256,
+                              check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        if new_db:
+            for query in create_queries:
+                con.cursor().execute(query)
+            con.commit()
+        if db_path not in sqlite_migrated_paths:
+            if migrate is not None:
+                migrate(con)
+            sqlite_migrated_paths.add(db_path)
+    return con
+
+def release_sqlite_connections():
+    """
+    Returns connections used by the current thread to the pool shared by threads, closes the least recently
+    used idle connections above the pool limits.
+    Is called at the end of each web request (request threads are short-lived) and of each task of worker
+    """
+    used = sqlite_connections.__dict__.pop('pool', None)
+    if not used:
+        return
+    for con in used.values():
+        con.rollback()  # not committed transaction should not be seen by the next user
+    to_close = []
+    with sqlite_pool_lock:
+        for db_path, con in used.items():
+            idle = sqlite_idle_connections.pop(db_path, [])  # reinserted as the most recently used
+            sqlite_idle_connections[db_path] = idle
+            idle.append(con)
+            if len(idle) > Config.SQLITE_IDLE_PER_DB:
+                to_close.append(idle.pop(0))
+        n_idle = sum(len(idle) for idle in sqlite_idle_connections.values())
+        while n_idle > Config.SQLITE_IDLE_TOTAL:
+            db_path, idle = next(iter(sqlite_idle_connections.items()))
+            to_close.append(idle.pop(0))
+            n_idle -= 1
+            if not idle:
+                del sqlite_idle_connections[db_path]
+    for con in to_close:
+        con.close()
 
 
 class User:
@@ -73,15 +262,23 @@ class User:
     @staticmethod
     def _users_sql_conn(data_root):
         users_db_file_name = data_root / "all_users.db"
-        timeout = 0.1
-        new_db = not os.path.isfile(users_db_file_name)
-        con = sqlite3.connect(str(users_db_file_name), timeout=timeout)
-        if new_db:
-            con.cursor().execute(
-                "CREATE TABLE users(id text PRIMARY KEY, name text, email text, network_name text, network_id text, password_hash text, reg_date text, params text)")
+        return sqlite_connection(users_db_file_name, create_queries=[
+            "CREATE TABLE users(id text PRIMARY KEY, name text, email text, network_name text, network_id text, password_hash text, reg_date text, params text, email_norm text)",
             #_convert_users_from_json(users_db_file_name, con)
-            con.commit()
-        return con
+        ], migrate=User._migrate_users_db)
+
+    @staticmethod
+    def _migrate_users_db(con):
+        """
+        email_norm = trim(lower(email)) column (filled by SQL, so that it is consistent with queries)
+        and indexes for user lookups. email_norm is also filled for users inserted without it
+        """
+        columns = [row[1] for row in con.cursor().execute("PRAGMA table_info(users)").fetchall()]
+        if "email_norm" not in columns:
+            exec_sqlite(con, "ALTER TABLE users ADD COLUMN email_norm text", ())
+        exec_sqlite(con, "update users set email_norm = trim(lower(email)) where email_norm is null", ())
+        exec_sqlite(con, "CREATE INDEX IF NOT EXISTS users_email_norm ON users(email_norm)", ())
+        exec_sqlite(con, "CREATE INDEX IF NOT EXISTS users_network ON users(network_name, network_id)", ())
 
     @staticmethod
     def _convert_users_from_json(users_db_file_name, con):
@@ -91,8 +288,8 @@ class User:
             with open(json_file, encoding='utf-8') as f:
                 all_users = json.load(f)
             for id, user_dict in all_users.items():
-                con.cursor().execute("INSERT INTO users(id, name, email) VALUES(?, ?, ?)",
-                                     (id, user_dict["name"], user_dict["email"]))
+                con.cursor().execute("INSERT INTO users(id, name, email, email_norm) VALUES(?, ?, ?, trim(lower(?)))",
+                                     (id, user_dict["name"], user_dict["email"], user_dict["email"]))
 
     def __init__(self, id, user_dict, data_root):
         """
@@ -190,13 +387,15 @@ class User:
         send_email(msg)
 
 
-def exec_sqlite(con, query, params, timeout=10):
+def exec_sqlite(con, query, params, timeout=10, row_factory=None):
     """
     Пытается выполнить команду над sqlite, при ошибке повторяет в течение timeout секунд.
+    Ожидание блокировки делает сам sqlite (см. sqlite_connection), повтор нужен, только если оно не помогло.
     :param con: connection
     :param query: sql text
     :param params: tuple or dict of params
     :param timeout: seconds
+    :param row_factory: row factory for results, i.e. sqlite3.Row. Default - tuples
     :return: result of query
     """
     t0 = timeit.default_timer()
@@ -204,15 +403,182 @@ def exec_sqlite(con, query, params, timeout=10):
     while True:
         i += 1
         try:
-            res = con.cursor().execute(query, params).fetchall()
+            cursor = con.cursor()
+            if row_factory is not None:
+                cursor.row_factory = row_factory
+            res = cursor.execute(query, params).fetchall()
             con.commit()
             return res
         except sqlite3.OperationalError as e:
+            con.rollback()
             t = timeit.default_timer()
             if t > t0 + timeout:
                 raise Exception("{} {} times {} to {} for {}".format(str(e), i, t, t0, query))
             time.sleep(0.1)
 
+class TaskQueue:
+    """
+    Очередь задач на распознавание, общая для всех пользователей и процессов (data_root/queue.db).
+    Задача выдается worker'у в аренду (lease) на lease_time секунд, worker продлевает ее, пока обрабатывает задачу.
+    Если worker упал, аренда истекает и задача выдается снова.
+    """
+    PRIORITY_IMAGE = 0
+    PRIORITY_ARCHIVE = 1  # zip архивы и pdf обрабатываются после одиночных изображений
+    MAX_ATTEMPTS = 3  # задача, которая не была завершена после стольких аренд, считается ошибочной
+
+    def __init__(self, data_root):
+        self.db_file_name = Path(data_root) / "queue.db"
+
+    def _sql_conn(self):
+        return sqlite_connection(self.db_file_name, create_queries=[
+            "CREATE TABLE IF NOT EXISTS queue(task_id text PRIMARY KEY, priority int, enqueue_time real,"
+            " lease_owner text, lease_expiry real, attempts int)",
+            "CREATE INDEX IF NOT EXISTS queue_order ON queue(priority, enqueue_time)",
+        ])
+
+    @classmethod
+    def priority(cls, file_name):
+        return cls.PRIORITY_ARCHIVE if Path(file_name).suffix.lower() in ('.zip', '.pdf') else cls.PRIORITY_IMAGE
+
+    def enqueue(self, task_id, priority):
+        """
+        Ставит задачу в очередь, если ее там еще нет
+        """
+        with self._sql_conn() as con:
+            exec_sqlite(con, "insert or ignore into queue(task_id, priority, enqueue_time, lease_owner, lease_expiry, attempts)"
+                             " values(?, ?, ?, NULL, NULL, 0)", (task_id, priority, time.time()))
+
+    def lease(self, owner, lease_time, task_id=None):
+        """
+        Выдает в аренду owner'у первую по приоритету и времени постановки свободную задачу
+        (или задачу task_id, если она свободна). Свободна задача, аренда которой не выдавалась или истекла.
+        owner должен быть уникален для процесса/потока.
+        :return: (task_id, attempts) or None if there is no free task
+        """
+        now = time.time()
+        params = {"owner": owner, "expiry": now + lease_time, "now": now, "task_id": task_id}
+        with self._sql_conn() as con:
+            # один запрос, чтобы задачу не могли одновременно получить два worker'а
+            exec_sqlite(con, "update queue set lease_owner=:owner, lease_expiry=:expiry, attempts=attempts+1"
+                             " where task_id = (select task_id from queue"
+                             "   where (lease_expiry is NULL or lease_expiry < :now)"
+                             "   and (:task_id is NULL or task_id = :task_id)"
+                             "   order by priority, enqueue_time limit 1)", params)
+            res = exec_sqlite(con, "select task_id, attempts from queue where lease_owner=:owner and lease_expiry=:expiry",
+                              params)
+        if not res:
+            return None
+        return res[0][0], res[0][1]
+
+    def renew(self, task_id, owner, lease_time):
+        """
+        Продлевает аренду. Возвращает False, если аренда уже истекла и задача выдана другому worker'у
+        """
+        with self._sql_conn() as con:
+            exec_sqlite(con, "update queue set lease_expiry=? where task_id=? and lease_owner=?",
+                        (time.time() + lease_time, task_id, owner))
+            res = exec_sqlite(con, "select 1 from queue where task_id=? and lease_owner=?", (task_id, owner))
+        return len(res) > 0
+
+    def complete(self, task_id, owner):
+        with self._sql_conn() as con:
+            exec_sqlite(con, "delete from queue where task_id=? and lease_owner=?", (task_id, owner))
+
+
+def file_sha256(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+model_hash = None
+
+def get_model_hash():
+    """
+    Hash of model parameters and weights files. Is calculated once per process
+    """
+    global model_hash
+    if model_hash is None:
+        model_hash = hashlib.sha256((
+            file_sha256(os.path.join(MODEL_PATH, 'weights', 'param.txt')) +
+            file_sha256(os.path.join(MODEL_PATH, 'weights', MODEL_WEIGHTS))).encode()).hexdigest()
+    return model_hash
+
+
+class ResultCache:
+    """
+    Кэш результатов распознавания (data_root/results_cache.db): ключ - хэш содержимого загруженного файла,
+    параметров распознавания и модели, значение - пути к результатам (относительно results_dir).
+    Позволяет не распознавать повторно тот же файл с теми же параметрами.
+    """
+    CACHE_PARAMS = ('lang', 'find_orientation', 'process_2_sides')  # params that affect recognition results
+
+    def __init__(self, data_root):
+        self.db_file_name = Path(data_root) / "results_cache.db"
+
+    def _sql_conn(self):
+        return sqlite_connection(self.db_file_name, create_queries=[
+            "CREATE TABLE IF NOT EXISTS cache(key text PRIMARY KEY, results text, thumbnail_desc text, create_date text)",
+        ])
+
+    def make_key(self, raw_path, param_dict):
+        params = json.dumps({k: param_dict.get(k) for k in self.CACHE_PARAMS}, sort_keys=True)
+        return hashlib.sha256((file_sha256(raw_path) + params + get_model_hash()).encode()).hexdigest()
+
+    def get(self, key, results_root):
+        """
+        :return: (results, thumbnail_desc) or None if key is not found or result files were removed
+        """
+        with self._sql_conn() as con:
+            res = exec_sqlite(con, "select results, thumbnail_desc from cache where key=?", (key,))
+        if not res:
+            return None
+        results, thumbnail_desc = res[0]
+        for file_names in json.loads(results):
+            for file_name in file_names:
+                if not (Path(results_root) / file_name).is_file():
+                    return None
+        return results, thumbnail_desc
+
+    def put(self, key, results, thumbnail_desc):
+        with self._sql_conn() as con:
+            exec_sqlite(con, "insert or replace into cache(key, results, thumbnail_desc, create_date) values(?, ?, ?, ?)",
+                        (key, results, thumbnail_desc, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def recognition_worker(data_root_path, stop_event, num_threads, lease_time, poll_interval=0.2):
+    """
+    Main function of recognition worker process (see AngelinaSolver.start_workers).
+    Loads the model and processes tasks leased from TaskQueue until stop_event is set
+    """
+    import torch
+    torch.set_num_threads(num_threads)
+    solver = AngelinaSolver(data_root_path)
+    solver.get_recognizer()
+    owner = "{}:{}".format(socket.gethostname(), os.getpid())
+    while not stop_event.is_set():
+        leased = solver.task_queue.lease(owner, lease_time)
+        if leased is None:
+            stop_event.wait(poll_interval)
+            continue
+        solver.run_leased_task(leased[0], leased[1], owner, lease_time)
+        release_sqlite_connections()
+
+
+def worker_python_executable():
+    """
+    Python interpreter for spawned recognition workers: Config.WORKER_PYTHON or sys.executable.
+    If sys.executable is not python (app is run by WSGI server, i.e. mod_wsgi in Apache), python of sys.exec_prefix
+    """
+    if Config.WORKER_PYTHON:
+        return Config.WORKER_PYTHON
+    if Path(sys.executable).name.lower().startswith('python'):
+        return sys.executable
+    return str(Path(sys.exec_prefix) / ('python.exe' if os.name == 'nt' else 'bin/python3'))
+
+
 class AngelinaSolver:
     """
     Обеспечивает интерфейс с вычислительной системой: пользователи, задачи и результаты обработки
@@ -223,16 +589,102 @@ class AngelinaSolver:
         self.raw_images_dir = Path('raw')
         self.results_dir = Path('results')
         os.makedirs(self.data_root, exist_ok=True)
+        self.task_queue = TaskQueue(self.data_root)
+        self.results_cache = ResultCache(self.data_root)
+        self.lease_time = Config.TASK_LEASE_TIME
+        self.workers = []
+        self.workers_stop_event = None
+
+    def start_workers(self, n_workers):
+        """
+        Starts n_workers recognition processes, each with its own loaded model. Workers take tasks from task_queue,
+        is_completed() only waits for results. If no workers are started, recognition is done by is_completed()
+        in the request thread.
+        Tasks loaded before the start (i.e. before restart of the server) are put to the queue too
+        """
+        self.enqueue_loaded_tasks()
+        if n_workers <= 0:
+            return
+        ctx = multiprocessing.get_context('spawn')  # fork is unsafe with torch and threaded Flask
+        ctx.set_executable(worker_python_executable())
+        self.workers_stop_event = ctx.Event()
+        num_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        for i in range(n_workers):
+            worker = ctx.Process(target=recognition_worker,
+                                 args=(str(self.data_root), self.workers_stop_event, num_threads, self.lease_time),
+                                 name="recognition_worker_{}".format(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        atexit.register(self.stop_workers)
+
+    def enqueue_loaded_tasks(self):
+        """
+        Puts to task_queue tasks of all users in RAW_FILE_LOADED state which are not in the queue
+        """
+        for db_path in sorted((self.data_root / self.tasks_dir).glob("*.db")):
+            # dbs of all users are not kept in the pool of connections
+            with contextlib.closing(sqlite3.connect(str(db_path), timeout=Config.SQLITE_BUSY_TIMEOUT)) as con:
+                res = exec_sqlite(con, "select user_id, doc_id, raw_paths from tasks where state=?",
+                                  (TaskState.RAW_FILE_LOADED.value,))
+            for user_id, doc_id, raw_paths in res:
+                self.task_queue.enqueue(user_id + "_" + doc_id, TaskQueue.priority(raw_paths))
+
+    def drop_dead_workers(self):
+        """
+        Removes finished worker processes (i.e. crashed at start), so that is_completed runs tasks itself
+        if no workers are alive
+        """
+        alive = [worker for worker in self.workers if worker.is_alive()]
+        if len(alive) != len(self.workers):
+            print("Recognition workers finished: {}".format(
+                [(worker.name, worker.exitcode) for worker in self.workers if not worker.is_alive()]))
+            self.workers = alive
+
+    def stop_workers(self, timeout=10):
+        if not self.workers:
+            return
+        self.workers_stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def run_leased_task(self, task_id, attempts, owner, lease_time):
+        """
+        Runs task leased from task_queue renewing the lease while it is processed and removes it from the queue
+        """
+        stop_renewal = threading.Event()
+        def renew_lease():
+            while not stop_renewal.wait(lease_time / 3):
+                self.task_queue.renew(task_id, owner, lease_time)
+            release_sqlite_connections()
+        renewal_thread = threading.Thread(target=renew_lease, daemon=True)
+        renewal_thread.start()
+        try:
+            if attempts > TaskQueue.MAX_ATTEMPTS:
+                print("Task {} failed {} times".format(task_id, attempts - 1))
+                self.set_task_state(task_id, TaskState.ERROR)
+            else:
+                # state can be PROCESSING_STARTED if previous worker crashed
+                self.run_task(task_id, restart=attempts > 1)
+        except Exception as e:
+            print("Error processing task {}: {}".format(task_id, str(e)))
+            self.set_task_state(task_id, TaskState.ERROR)
+        finally:
+            stop_renewal.set()
+            renewal_thread.join()
+        self.task_queue.complete(task_id, owner)
 
     def get_recognizer(self):
         global recognizer
         if recognizer is None:
+            import model.infer_retinanet as infer_retinanet  # torch and the model are loaded by recognizing processes only
             print("infer_retinanet.BrailleInference()")
             t = timeit.default_timer()
             recognizer = infer_retinanet.BrailleInference(verbose=1,
                 params_fn=os.path.join(MODEL_PATH, 'weights', 'param.txt'),
                 model_weights_fn=os.path.join(MODEL_PATH, 'weights', MODEL_WEIGHTS),
-                create_script=None)
+                create_script=None,
+                page_workers=Config.PAGE_WORKERS)
             print(timeit.default_timer() - t)
         return recognizer
 
@@ -264,7 +716,7 @@ class AngelinaSolver:
         if existing_user:
             raise AngelinaException(f"Такой пользователь уже есть: {(network_name, network_id, email)}", f"Such user already exists: {(network_name, network_id, email)}")
         with User._users_sql_conn(self.data_root) as con:
-            exec_sqlite(con, "insert into users(id, name, email, network_name, network_id, password_hash, reg_date, params) values(:id, :name, :email, :network_name, :network_id, :password_hash, :reg_date, :params)", new_user)
+            exec_sqlite(con, "insert into users(id, name, email, network_name, network_id, password_hash, reg_date, params, email_norm) values(:id, :name, :email, :network_name, :network_id, :password_hash, :reg_date, :params, trim(lower(:email)))", new_user)
         user = User(id, new_user, data_root=self.data_root)
         return user
 
@@ -274,7 +726,6 @@ class AngelinaSolver:
         Если юзер не найден, возвращает None
         """
         con = User._users_sql_conn(self.data_root)
-        con.row_factory = sqlite3.Row
         if id:
             assert not network_name and not network_id and not email, (22060503, network_name, network_id, email)
             query = ("select * from users where id = ?", (id,))
@@ -283,8 +734,8 @@ class AngelinaSolver:
             query = ("select * from users where network_name = ? and network_id = ?", (network_name,network_id,))
         else:
             assert email and not network_name and not network_id, (22060505, network_name, network_id, email)
-            query = ("select * from users where trim(lower(email)) = trim(lower(?)) and (network_name is NULL or network_name='') and (network_id is NULL or network_id='') order by reg_date desc", (email,))
-        res = exec_sqlite(con, query[0], query[1])
+            query = ("select * from users where email_norm = trim(lower(?)) and (network_name is NULL or network_name='') and (network_id is NULL or network_id='') order by reg_date desc", (email,))
+        res = exec_sqlite(con, query[0], query[1], row_factory=sqlite3.Row)
         if len(res):
             user_dict = dict(res[0])  # sqlite row -> dict
             user = User(id=user_dict["id"], user_dict=user_dict, data_root=self.data_root)
@@ -298,8 +749,8 @@ class AngelinaSolver:
         Может вернуть пустой словарь, словарь из одного или список из нескольких юзеров.
         """
         con = User._users_sql_conn(self.data_root)
-        con.row_factory = sqlite3.Row
-        res = exec_sqlite(con, "select * from users where trim(lower(email)) = trim(lower(?)) order by reg_date desc", (email,))
+        res = exec_sqlite(con, "select * from users where email_norm = trim(lower(?)) order by reg_date desc", (email,),
+                          row_factory=sqlite3.Row)
         found = dict()
         for row in res:
             user_dict = dict(row)  # sqlite row -> dict
@@ -307,21 +758,21 @@ class AngelinaSolver:
         return found
 
     def _user_tasks_sql_conn(self, user_id):
-        timeout = 0.1
         db_dir = self.data_root / self.tasks_dir
         if not user_id:
             user_id = "unregistered"
         db_path = db_dir / (user_id + ".db")
-        new_db = not os.path.isfile(db_path)
-        if new_db:
+        if not os.path.isfile(db_path):
             os.makedirs(db_dir, exist_ok=True)
-        con = sqlite3.connect(str(db_path), timeout=timeout)
-        if new_db:
-            con.cursor().execute(
-                "CREATE TABLE tasks(doc_id text PRIMARY KEY, create_date text, name text, user_id text, params text,"
-                " raw_paths text, state int, results text, thumbnail text, is_public int, thumbnail_desc text, is_deleted int)")
-            con.commit()
-        return con
+        return sqlite_connection(db_path, create_queries=[
+            "CREATE TABLE tasks(doc_id text PRIMARY KEY, create_date text, name text, user_id text, params text,"
+            " raw_paths text, state int, results text, thumbnail text, is_public int, thumbnail_desc text, is_deleted int)",
+        ], migrate=self._migrate_tasks_db)
+
+    @staticmethod
+    def _migrate_tasks_db(con):
+        # index for task list and prev/next navigation (see get_results, get_tasks_list)
+        exec_sqlite(con, "CREATE INDEX IF NOT EXISTS tasks_by_date ON tasks(user_id, is_deleted, create_date, doc_id)", ())
 
 
     ##########################################
@@ -430,13 +881,68 @@ class AngelinaSolver:
         file_storage.save(str(raw_path))
 
         task["raw_paths"] = raw_image_fn
+        task_id = user_id + "_" + doc_id
+        cached = self.results_cache.get(self.results_cache.make_key(raw_path, param_dict),
+                                        self.data_root / self.results_dir)
+        if cached is not None:
+            # the same file was already recognized with the same params: use its results
+            task["state"] = TaskState.PROCESSING_DONE.value
+            task["results"], task["thumbnail_desc"] = cached
+            task["thumbnail"] = "pic.jpg"  # TODO
+            exec_sqlite(con, "update tasks set raw_paths=:raw_paths, state=:state, results=:results, thumbnail=:thumbnail,"
+                             " thumbnail_desc=:thumbnail_desc where doc_id=:doc_id", task)
+            return task_id
         task["state"] = TaskState.RAW_FILE_LOADED.value
         exec_sqlite(con, "update tasks set raw_paths=:raw_paths, state=:state where doc_id=:doc_id", task)
-        return user_id + "_" + doc_id
+        self.task_queue.enqueue(task_id, TaskQueue.priority(raw_image_fn))
+        return task_id
+
+    def get_task_state(self, task_id):
+        user_id, doc_id = task_id.split("_")
+        con = self._user_tasks_sql_conn(user_id)
+        result = exec_sqlite(con, "select state from tasks where doc_id=:doc_id", {"doc_id": doc_id})
+        if len(result) != 1:
+            raise AngelinaException(f"Ошибочный запрос {user_id}_{doc_id} {len(result)}", f"Invalid request {user_id}_{doc_id} {len(result)}")
+        return result[0][0]
+
+    def set_task_state(self, task_id, state):
+        user_id, doc_id = task_id.split("_")
+        con = self._user_tasks_sql_conn(user_id)
+        exec_sqlite(con, "update tasks set state=:state where doc_id=:doc_id", {"state": state.value, "doc_id": doc_id})
 
     def is_completed(self, task_id, timeout=0):
         """
         Проверяет, завершена ли задача с заданным id
+        timeout: время ожидания завершения в секундах. None или < 0 - ждать до завершения, 0 - не ждать.
+        Если worker процессы не запущены (см. start_workers), при timeout != 0 задача выполняется в текущем потоке.
+        """
+        state = self.get_task_state(task_id)
+        if state in (TaskState.PROCESSING_DONE.value, TaskState.ERROR.value):
+            return True
+
+        if timeout == 0:  # calculation should be done on /result_test/<string:item_id>/ where timeout > 0
+            return False
+
+        t0 = timeit.default_timer()
+        while True:
+            self.drop_dead_workers()
+            if not self.workers:
+                # no workers in this process: run the task here unless it is leased by a worker of another process
+                owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.get_ident())
+                leased = self.task_queue.lease(owner, self.lease_time, task_id=task_id)
+                if leased is not None:
+                    with recognizer_lock:
+                        self.run_leased_task(leased[0], leased[1], owner, self.lease_time)
+            if self.get_task_state(task_id) in (TaskState.PROCESSING_DONE.value, TaskState.ERROR.value):
+                return True
+            if timeout is not None and timeout >= 0 and timeit.default_timer() - t0 >= timeout:
+                return False
+            time.sleep(0.1)
+
+    def run_task(self, task_id, restart=False):
+        """
+        Распознает задачу task_id, если она еще не начата (или начата, но не завершена, если restart),
+        сохраняет результаты и обновляет ее состояние
         """
         user_id, doc_id = task_id.split("_")
         task = { "doc_id": doc_id }
@@ -450,11 +956,9 @@ class AngelinaSolver:
             "raw_paths": result[0][1],
             "state": result[0][2]
         }
-        if task["state"] in (TaskState.PROCESSING_DONE.value, TaskState.ERROR.value):
-            return True
-
-        if timeout == 0:  # calculation should be done on /result_test/<string:item_id>/ where timeout > 0
-            return False
+        if task["state"] != TaskState.RAW_FILE_LOADED.value and not (
+                restart and task["state"] == TaskState.PROCESSING_STARTED.value):
+            return
 
         ### вычисления
         task["state"] = TaskState.PROCESSING_STARTED.value
@@ -462,15 +966,17 @@ class AngelinaSolver:
         file_ext = Path(task["raw_paths"]).suffix.lower()
         raw_path = self.data_root / self.raw_images_dir / task["raw_paths"]
         param_dict = json.loads(task["params"])
-        if file_ext[1:] == 'zip':
-            results_list = self.get_recognizer().process_archive_and_save(raw_path, self.data_root / self.results_dir,
-                                                                    lang=param_dict['lang'], extra_info=param_dict,
-                                                                    draw_refined=self.get_recognizer().DRAW_NONE,
-                                                                    remove_labeled_from_filename=False,
-                                                                    find_orientation=param_dict['find_orientation'],
-                                                                    align_results=True,
-                                                                    process_2_sides=param_dict['process_2_sides'],
-                                                                    repeat_on_aligned=False)
+        if file_ext[1:] in ('zip', 'pdf'):
+            process_pages_and_save = (self.get_recognizer().process_archive_and_save if file_ext[1:] == 'zip'
+                                      else self.get_recognizer().process_pdf_and_save)
+            results_list = process_pages_and_save(raw_path, self.data_root / self.results_dir,
+                                                  lang=param_dict['lang'], extra_info=param_dict,
+                                                  draw_refined=self.get_recognizer().DRAW_NONE,
+                                                  remove_labeled_from_filename=False,
+                                                  find_orientation=param_dict['find_orientation'],
+                                                  align_results=True,
+                                                  process_2_sides=param_dict['process_2_sides'],
+                                                  repeat_on_aligned=False)
 
         else:
             results_list = self.get_recognizer().run_and_save(raw_path, self.data_root / self.results_dir, target_stem=None,
@@ -484,7 +990,7 @@ class AngelinaSolver:
         if results_list is None or len(results_list) == 0:
             task["state"] = TaskState.ERROR.value
             exec_sqlite(con, "update tasks set state=:state where doc_id=:doc_id", task)
-            return True
+            return
 
         # full path -> relative to data path
         result_files = list()
@@ -500,7 +1006,7 @@ class AngelinaSolver:
         with (self.data_root / self.results_dir / result_files[0][1]).open(encoding="utf-8") as f:
             task["thumbnail_desc"] = ''.join(f.readlines()[:3])
         exec_sqlite(con, "update tasks set state=:state, results=:results, thumbnail=:thumbnail, thumbnail_desc=:thumbnail_desc where doc_id=:doc_id", task)
-        return True
+        self.results_cache.put(self.results_cache.make_key(raw_path, param_dict), task["results"], task["thumbnail_desc"])
 
     def get_results(self, task_id):
         """
@@ -520,31 +1026,29 @@ class AngelinaSolver:
         """
         user_id, doc_id = task_id.split("_")
 
-        prev_slag = next_slag = result = None
+        prev_slag = next_slag = None
         con = self._user_tasks_sql_conn(user_id)
+        results = exec_sqlite(con, "select doc_id, name, create_date, params, state, results, is_public"
+                                   " from tasks"
+                                   " where doc_id=:doc_id and is_deleted=0",
+                                   {"doc_id": doc_id})
+        assert len(results) == 1, (22060508, user_id, doc_id)
+        result = results[0]
         if user_id:
-            results = exec_sqlite(con, "select doc_id, name, create_date, params, state, results, is_public"
-                                       " from tasks"
-                                       " where user_id=:user_id and is_deleted=0"
-                                       " order by create_date desc",
-                                       {"user_id": user_id})
-            for r in results:
-                if r[0] == doc_id:
-                    result = r
-                else:
-                    if result is None:
-                        next_slag = user_id + "_" + r[0]
-                    else:
-                        prev_slag = user_id + "_" + r[0]
-                        break
-        else:
-            results = exec_sqlite(con, "select doc_id, name, create_date, params, state, results, is_public"
-                                      " from tasks"
-                                      " where doc_id=:doc_id and is_deleted=0",
-                                      {"doc_id": doc_id})
-            assert len(results) == 1, (22060508, user_id, doc_id)
-            result = results[0]
-        assert result is not None, (22060509, user_id, doc_id)
+            # соседние по (create_date, doc_id) задачи: next - более новая, prev - более старая
+            key = {"user_id": user_id, "create_date": result[2], "doc_id": doc_id}
+            next_task = exec_sqlite(con, "select doc_id from tasks"
+                                         " where user_id=:user_id and is_deleted=0"
+                                         " and (create_date, doc_id) > (:create_date, :doc_id)"
+                                         " order by create_date, doc_id limit 1", key)
+            prev_task = exec_sqlite(con, "select doc_id from tasks"
+                                         " where user_id=:user_id and is_deleted=0"
+                                         " and (create_date, doc_id) < (:create_date, :doc_id)"
+                                         " order by create_date desc, doc_id desc limit 1", key)
+            if next_task:
+                next_slag = user_id + "_" + next_task[0][0]
+            if prev_task:
+                prev_slag = user_id + "_" + prev_task[0][0]
         if result[4] == TaskState.ERROR.value:
             raise AngelinaException("Ошибка распознавания документа", "Document recognition error")
         assert result[4] == TaskState.PROCESSING_DONE.value, (22060510, user_id, doc_id, result[4])
@@ -568,18 +1072,26 @@ class AngelinaSolver:
                 }
         return res_dict
 
-    def get_tasks_list(self, user_id, count=None):
+    def get_tasks_list(self, user_id, count=None, after_task_id=None):
         """
         count - кол-во запиисей
-        Возвращает список task_id задач для данного юзера, отсортированный от старых к новым
+        after_task_id - для постраничного вывода: task_id последней задачи предыдущей страницы
+        Возвращает список task_id задач для данного юзера, отсортированный от новых к старым
         """
         if not user_id:
             return []
         con = self._user_tasks_sql_conn(user_id)
+        params = {"user_id": user_id, "count": count or -1, "create_date": None, "doc_id": None}
+        if after_task_id:
+            params["doc_id"] = after_task_id.split("_")[1]
+            after_task = exec_sqlite(con, "select create_date from tasks where doc_id=:doc_id", params)
+            assert len(after_task) == 1, (22060515, user_id, after_task_id)
+            params["create_date"] = after_task[0][0]
         results = exec_sqlite(con, "select doc_id, create_date, name, thumbnail, thumbnail_desc, is_public, state"
                                    " from tasks where user_id=:user_id and is_deleted=0"
-                                   " order by create_date desc",
-                    {"user_id": user_id})
+                                   " and (:doc_id is NULL or (create_date, doc_id) < (:create_date, :doc_id))"
+                                   " order by create_date desc, doc_id desc limit :count",
+                    params)
         lst = [
                   {
                     "id": user_id + "_" + rec[0],
@@ -593,13 +1105,12 @@ class AngelinaSolver:
                    }
             for rec in results
         ]
-        if count:
-            lst = lst[:count]
         return lst
 
     # отправка почты
     def send_mail(self, to_address, subject, comment, results_list,
-                  file_types_to_send=None, braille_as_unicode=True):
+                  file_types_to_send=None, braille_as_unicode=True, as_archive=None, archive_name="results.zip",
+                  max_message_size=None):
         """
         Sends results to e-mail as text(s) + image(s)
         :param to_address: destination email as str
@@ -607,32 +1118,85 @@ class AngelinaSolver:
         :param comment: message text before result files or None
         :param results_list: list of tuples with file names(txt or jpg)
         :param file_types_to_send: None or list of file extensions like [".jpg", ".txt"]
+        :param as_archive: True - send files as zip archive, False - as separate attachments,
+            None - as archive if total size of files exceeds max_message_size
+        :param archive_name: attachment name for as_archive mode
+        :param max_message_size: max. size of files attached to one message (Config.MAIL_MAX_SIZE by default).
+            Files that don't fit are sent in several messages. Messages are built one by one when they are sent,
+            so only one of them is in memory
         """
-        # create message object instance
-        msg = fill_message_headers(MIMEMultipart(), to_address, subject)
-        attachment = MIMEText(comment, _charset="utf-8")
-        msg.attach(attachment)
-        # attach image to message body
+        max_message_size = max_message_size or Config.MAIL_MAX_SIZE
+        file_names_to_send = []
         for file_names in results_list:
             for file_name in reversed(file_names):  # txt before jpg
                 file_suffix = Path(file_name).suffix
                 if file_types_to_send and not file_suffix in file_types_to_send:
                     continue
-                if file_suffix in (".txt", ".brl"):
-                    txt = (self.data_root / self.results_dir / file_name).read_text(encoding="utf-8")
-                    attachment_filename = Path(file_name).name
-                    if file_suffix == ".brl" and not braille_as_unicode:
-                        attachment_filename = Path(file_name).with_suffix(".brf").name
-                        txt = "".join([lt.unicode_to_ascii(ch) if ch not in ('\r', '\n') else ch for ch in txt])
-                    attachment = MIMEText(txt, _charset="utf-8")
-                    attachment.add_header('Content-Disposition', 'inline', filename=attachment_filename)
-                elif file_suffix == ".jpg":
-                    attachment = MIMEImage((self.data_root / self.results_dir / file_name).read_bytes())
-                    attachment.add_header('Content-Disposition', 'inline', filename=Path(file_name).name)
-                else:
-                    assert False, (22060511, str(file_name))
+                assert file_suffix in (".txt", ".brl", ".jpg"), (22060511, str(file_name))
+                file_names_to_send.append(file_name)
+        # split files to messages by size
+        parts = [[]]
+        part_size = total_size = 0
+        for file_name in file_names_to_send:
+            file_size = (self.data_root / self.results_dir / file_name).stat().st_size
+            if parts[-1] and part_size + file_size > max_message_size:
+                parts.append([])
+                part_size = 0
+            parts[-1].append(file_name)
+            part_size += file_size
+            total_size += file_size
+        if as_archive is None:
+            as_archive = total_size > max_message_size
+
+        def make_message(part_idx):
+            part_subject = subject if len(parts) == 1 else "{} ({}/{})".format(subject, part_idx + 1, len(parts))
+            msg = fill_message_headers(MIMEMultipart(), to_address, part_subject)
+            attachment = MIMEText(comment, _charset="utf-8")
+            msg.attach(attachment)
+            if as_archive:
+                part_archive_name = archive_name if len(parts) == 1 else "{}.{}{}".format(
+                    Path(archive_name).stem, part_idx + 1, Path(archive_name).suffix)
+                with tempfile.TemporaryFile() as f:
+                    with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                        for file_name in parts[part_idx]:
+                            attachment_filename, txt = self.result_file_text(file_name, braille_as_unicode)
+                            if txt is None:
+                                archive.write(self.data_root / self.results_dir / file_name, arcname=attachment_filename)
+                            else:
+                                archive.writestr(attachment_filename, txt)
+                    f.seek(0)
+                    attachment = MIMEApplication(f.read(), "zip")
+                attachment.add_header('Content-Disposition', 'attachment', filename=part_archive_name)
                 msg.attach(attachment)
-        send_email(msg)
+            else:
+                # attach image to message body
+                for file_name in parts[part_idx]:
+                    attachment_filename, txt = self.result_file_text(file_name, braille_as_unicode)
+                    if txt is not None:
+                        attachment = MIMEText(txt, _charset="utf-8")
+                    else:
+                        attachment = MIMEImage((self.data_root / self.results_dir / file_name).read_bytes())
+                    attachment.add_header('Content-Disposition', 'inline', filename=attachment_filename)
+                    msg.attach(attachment)
+            return msg
+
+        for part_idx in range(len(parts)):
+            send_email(functools.partial(make_message, part_idx))
+
+    def result_file_text(self, file_name, braille_as_unicode):
+        """
+        :return: attachment file name, text of .txt and .brl files (converted to ASCII braille if not
+            braille_as_unicode) or None for images
+        """
+        file_suffix = Path(file_name).suffix
+        if file_suffix not in (".txt", ".brl"):
+            return Path(file_name).name, None
+        txt = (self.data_root / self.results_dir / file_name).read_text(encoding="utf-8")
+        attachment_filename = Path(file_name).name
+        if file_suffix == ".brl" and not braille_as_unicode:
+            attachment_filename = Path(file_name).with_suffix(".brf").name
+            txt = "".join([lt.unicode_to_ascii(ch) if ch not in ('\r', '\n') else ch for ch in txt])
+        return attachment_filename, txt
 
     def send_results_to_mail(self, mail, task_id, parameters=None):
         """
@@ -646,6 +1210,7 @@ class AngelinaSolver:
             send_image
             send_text
             send_braille
+            as_archive - see send_mail
         """
         user_id, doc_id = task_id.split("_")
         con = self._user_tasks_sql_conn(user_id)
@@ -678,7 +1243,8 @@ class AngelinaSolver:
             file_types_to_send.append(".txt")
         if parameters.get("send_braille", True):
             file_types_to_send.append(".brl")
-        self.send_mail(mail, subject, comment, json.loads(result[1]), file_types_to_send=file_types_to_send, braille_as_unicode=parameters.get("unicode_braille", True))
+        self.send_mail(mail, subject, comment, json.loads(result[1]), file_types_to_send=file_types_to_send, braille_as_unicode=parameters.get("unicode_braille", True),
+                       as_archive=parameters.get("as_archive"), archive_name=Path(result[0]).stem + ".zip")
 
     def get_user_emails(self, user):
         """
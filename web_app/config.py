@@ -5,9 +5,29 @@ class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'angilina'
     MODEL_PATH = ""
     DATA_ROOT = os.environ.get('DATA_ROOT') or 'static/data'
+    # recognition worker processes, each loads its own model. 0 - recognize in request threads
+    RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS') or 0)
+    # python interpreter for worker processes. Default - sys.executable or, if it is not python
+    # (i.e. Apache with mod_wsgi), python of sys.exec_prefix
+    WORKER_PYTHON = os.environ.get('WORKER_PYTHON') or ""
+    # max. time (seconds) results page waits for recognition
+    RECOGNITION_TIMEOUT = int(os.environ.get('RECOGNITION_TIMEOUT') or 300)
+    # max. time (seconds) one request of results page waits, then the page is reloaded
+    RESULTS_WAIT_TIME = int(os.environ.get('RESULTS_WAIT_TIME') or 10)
+    # recognition threads per worker for pages of zip and pdf files, 0 - pages are recognized one after another.
+    # Every thread runs the model with all torch threads, so it may be slower on hosts with few cores
+    PAGE_WORKERS = int(os.environ.get('PAGE_WORKERS') or 0)
+    # seconds a worker keeps a task without renewal. Tasks of crashed workers are given to other workers after it
+    TASK_LEASE_TIME = int(os.environ.get('TASK_LEASE_TIME') or 60)
+    # seconds sqlite waits for a locked database before exec_sqlite retries
+    SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5)
+    # max. idle sqlite connections kept open for one db and for all dbs (there is a tasks db for every user)
+    SQLITE_IDLE_PER_DB = int(os.environ.get('SQLITE_IDLE_PER_DB') or 4)
+    SQLITE_IDLE_TOTAL = int(os.environ.get('SQLITE_IDLE_TOTAL') or 32)
     # e-mail parameters:
     SMTP_SERVER = os.environ.get('SMTP_SERVER') or "ovdv.ru"
     SMTP_PORT = os.environ.get('SMTP_PORT') or "587"
     SMTP_PWD = os.environ.get('SMTP_PWD') or ""
     SMTP_FROM = os.environ.get('SMTP_FROM') or "results@angelina-reader.ru"
+    MAIL_MAX_SIZE = int(os.environ.get('MAIL_MAX_SIZE') or 15*1024*1024)  # max. size of attachments in one message
     PERMANENT_SESSION_LIFETIME = datetime.timedelta(minutes=60*24*365*2)
\ No newline at end of file
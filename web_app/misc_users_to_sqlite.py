@@ -2,9 +2,9 @@ import json
 from pathlib import Path
 import sqlite3
 
-import angelina_reader_core
+from web_app import angelina_reader_core  # run from the project root: python -m web_app.misc_users_to_sqlite
 
-json_file = "static/data/all_users.json"
+json_file = Path(__file__).parent / "static/data/all_users.json"
 db_file = Path(json_file).with_suffix(".db")
 
 with open(json_file, encoding='utf-8') as f:
@@ -14,10 +14,12 @@ if db_file.is_file():
     con = sqlite3.connect(str(db_file))
 else:
     con = sqlite3.connect(str(db_file))
-    con.cursor().execute("CREATE TABLE users(id text PRIMARY KEY, name text, email text, network_name text, network_id text, password_hash text, reg_date text)")
+    con.cursor().execute("CREATE TABLE users(id text PRIMARY KEY, name text, email text, network_name text, network_id text, password_hash text, reg_date text, params text, email_norm text)")
     con.commit()
+angelina_reader_core.User._migrate_users_db(con)  # email_norm column and indexes for old db
 
 for id, user_dict in all_users.items():
-    con.cursor().execute("INSERT INTO users(id, name, email) VALUES(?, ?, ?)", (id, user_dict["name"], user_dict["email"]))
+    con.cursor().execute("INSERT INTO users(id, name, email, email_norm) VALUES(?, ?, ?, trim(lower(?)))",
+                         (id, user_dict["name"], user_dict["email"], user_dict["email"]))
 con.commit()
 
@@ -0,0 +1,76 @@
+"""
+Manual test of MailSender against a local stand-in SMTP server.
+Run from the project root: python -m web_app.test_mail_sender
+"""
+import socketserver
+import threading
+import time
+from email.mime.text import MIMEText
+
+from web_app.angelina_reader_core import MailSender, fill_message_headers
+
+messages = 20
+drop_connections = 2  # first connections are closed by server to check retries
+
+received = []
+connections = []
+
+
+class StandInSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP server: no TLS and no auth, stores received messages to received
+    """
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        connections.append(self.client_address)
+        if len(connections) <= drop_connections:
+            return
+        self.reply("220 stand-in")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            cmd = line[:4].upper()
+            if cmd == "EHLO":
+                self.reply("250 stand-in")
+            elif cmd in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif cmd == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while True:
+                    data_line = self.rfile.readline().decode()
+                    if data_line in (".\r\n", ".\n"):
+                        break
+                    data.append(data_line)
+                received.append("".join(data))
+                self.reply("250 OK")
+            elif cmd == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("500 unknown command")
+
+
+class StandInSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True  # sender keeps its session open
+
+
+server = StandInSMTPServer(("127.0.0.1", 0), StandInSMTPHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+sender = MailSender(server="127.0.0.1", port=server.server_address[1], login="", password="", use_tls=False,
+                    retry_delay=0.1)
+t0 = time.time()
+for i in range(messages):
+    msg = fill_message_headers(MIMEText("message {}".format(i), _charset="utf-8"), "user@angelina-reader.ru",
+                               "test {}".format(i))
+    sender.send(msg)
+print("queued {} messages in {:.3f} s".format(messages, time.time() - t0))
+assert sender.flush(timeout=30)
+print("sent in {:.3f} s, received {}, connections {}".format(time.time() - t0, len(received), len(connections)))
+assert len(received) == messages
+assert len(connections) == drop_connections + 1  # all messages are sent in one session
+server.shutdown()